@@ -1,16 +1,16 @@
 # This script calculates the cross-spacecraft separation between AC6 and FU3
+# The plotting and AC6 reader libraries are only imported when they are used
+# so batch jobs that calculate separations only need NumPy.
 from datetime import datetime, timedelta
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.dates as md
-import dateutil.parser
-from matplotlib.dates import date2num
 import sys
 import csv
 
+import lap_recurrence
+from ephemeris import Ephem, parse_times, to_epoch
+
 # My libraries
 sys.path.append('/home/mike/research/mission_tools/ac6/')
-import read_ac_data
 
 Re=6371 # km
 
@@ -37,19 +37,28 @@ class CalcDist():
         self._find_common_times() # Filter data by the same time stamps.
         return
         
-    def calc_dist(self):
+    def calc_dist(self, windows=None):
         """
         This is a wrapper function that calculates the total separation using
         greatCircleDist(). This function calculates the psudo in-track lag
         from the difference in latitude. Positive in-track separation implies 
         that you add the lag (or separation) to spacecraft B. 
+
+        If windows is a (start times, end times) tuple, e.g. from 
+        lap_recurrence.LapRecurrence.predict(), the ephemeris is first
+        filtered to the times inside those windows so the separation is 
+        only calculated (and saved) there.
         """
+        # The direction of motion is found before the window filtering so 
+        # that the first sample in each window is not differenced with the 
+        # last sample of the previous window.
+        direction = np.convolve([0.5, -0.5], self.bEphem['lat'], mode='same')
+        if windows is not None:
+            direction = direction[self._filter_windows(windows)]
         # Format inputs for haversine method.
         X1 = np.array([self.aEphem['lat'], self.aEphem['lon'], self.aEphem['alt']]).T
         X2 = np.array([self.bEphem['lat'], self.bEphem['lon'], self.bEphem['alt']]).T
         
-        direction = np.convolve([0.5, -0.5], self.bEphem['lat'], mode='same')
-        
         self.dTot = self._haversine(X1, X2) # Get total distance
         A = Re+(X1[:, 2]+X2[:, 2])/2 # Mean altitude
         # Find a rough fraction of total distance that is in-track.
@@ -74,7 +83,7 @@ class CalcDist():
                         'MLT_{}'.format(self.scA), 
                         'MLT_{}'.format(self.scB)])
             # Save data.
-            zz = zip(self.aEphem['dateTime'], self.dInTrack, self.dCrossTrack, 
+            zz = zip(self.aEphem.dateTime(), self.dInTrack, self.dCrossTrack, 
                     self.aEphem['L'], self.bEphem['L'], self.aEphem['MLT'], 
                     self.bEphem['MLT'])
             for z in zz:
@@ -83,15 +92,17 @@ class CalcDist():
 
     def plot_dist(self):
         """
-
+        This method plots the total, in-track, and cross-track separation.
         """
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots(3, figsize=(10, 8), sharex=True)
         ax_t = ax[1].twinx()
 
-        ax[0].plot(self.aEphem['dateTime'], self.dTot)
-        ax[1].plot(self.aEphem['dateTime'], self.dInTrack)
-        ax_t.plot(self.aEphem['dateTime'], self.dInTrack/7.5) # Assuming a 7.5 km/s orbital velocity
-        ax[2].plot(self.aEphem['dateTime'], self.dCrossTrack)
+        t = self.aEphem.datetime64()
+        ax[0].plot(t, self.dTot)
+        ax[1].plot(t, self.dInTrack)
+        ax_t.plot(t, self.dInTrack/7.5) # Assuming a 7.5 km/s orbital velocity
+        ax[2].plot(t, self.dCrossTrack)
         
         ax[0].set_title('{}-{} | {}-{} separation'.format(
             self.startDate.date(), self.endDate.date(), 
@@ -109,23 +120,19 @@ class CalcDist():
         This method loads in the ephemeris (magnetic ephemeris) that was 
         generated by Mike's SGP4 algorithm implementation. 
         """
-        ephem = {}
-        keys = ['dateTime', 'lat', 'lon', 'alt', 'L', 'MLT']
-
         with open(fPath) as f:
             r = csv.reader(f, quotechar='"')
             next(r)
             #keys = next(r)
             # Strip leading whitespce in keys
             #keys = [s.lstrip() for s in keys]        
-            rawData = list(r)
-        for (i, key) in enumerate(keys):
-            ephem[key] = np.array(rawData)[:, i]
-            if key != 'dateTime':
-                ephem[key] = ephem[key].astype(float)
-            else:
-                ephem['dateTime'] = np.array([dateutil.parser.parse(t) 
-                                    for t in ephem['dateTime']])
+            rawData = np.array(list(r))
+        ephem = Ephem(parse_times(rawData[:, 0]), {
+                    'lat':rawData[:, 1].astype(np.float64),
+                    'lon':rawData[:, 2].astype(np.float64),
+                    'alt':rawData[:, 3].astype(np.float64),
+                    'L':rawData[:, 4].astype(np.float64),
+                    'MLT':rawData[:, 5].astype(np.float64)})
         return ephem
         
     def _load_ac_ephem(self):
@@ -133,13 +140,9 @@ class CalcDist():
         This function will load in the coords data type from the AC6 directory
         and append them all to each other.
         """
-        ephem={}
-        ephem['dateTime'] = np.array([])
-        ephem['lat'] = np.array([])
-        ephem['lon'] = np.array([])
-        ephem['alt'] = np.array([])
-        ephem['L'] = np.array([])
-        ephem['MLT'] = np.array([])
+        import read_ac_data
+        ephem = [Ephem([], {'lat':np.array([]), 'lon':np.array([]), 
+                    'alt':np.array([]), 'L':np.array([]), 'MLT':np.array([])})]
 
         days = [self.startDate + timedelta(t) for t in 
                 range((self.endDate - self.startDate).days+1)]
@@ -152,13 +155,13 @@ class CalcDist():
                     continue
                 else:
                     raise
-            ephem['dateTime'] = np.append(ephem['dateTime'], rawAc['dateTime'])
-            ephem['lat'] = np.append(ephem['lat'], rawAc['lat'])
-            ephem['lon'] = np.append(ephem['lon'], rawAc['lon'])
-            ephem['alt'] = np.append(ephem['alt'], rawAc['alt'])
-            ephem['L'] = np.append(ephem['L'], rawAc['Lm_OPQ'])
-            ephem['MLT'] = np.append(ephem['MLT'], rawAc['MLT_OPQ'])
-        return ephem
+            ephem.append(Ephem(to_epoch(rawAc['dateTime']), {
+                    'lat':np.asarray(rawAc['lat'], dtype=np.float64),
+                    'lon':np.asarray(rawAc['lon'], dtype=np.float64),
+                    'alt':np.asarray(rawAc['alt'], dtype=np.float64),
+                    'L':np.asarray(rawAc['Lm_OPQ'], dtype=np.float64),
+                    'MLT':np.asarray(rawAc['MLT_OPQ'], dtype=np.float64)}))
+        return Ephem.concatenate(ephem)
 
     def _find_common_times(self):
         """
@@ -166,18 +169,25 @@ class CalcDist():
         stamps.
         """
         # Find common times
-        fbT = date2num(self.aEphem['dateTime'])
-        acT = date2num(self.bEphem['dateTime'])
-        fbInd = np.where(np.in1d(fbT, acT))[0]
-        acInd = np.where(np.in1d(acT, fbT))[0]
+        fbInd = np.where(np.isin(self.aEphem['time'], self.bEphem['time']))[0]
+        acInd = np.where(np.isin(self.bEphem['time'], self.aEphem['time']))[0]
 
         # Filter data
-        for key in self.aEphem:
-            self.aEphem[key] = self.aEphem[key][fbInd]
-        for key in self.bEphem:
-            self.bEphem[key] = self.bEphem[key][acInd]
+        self.aEphem = self.aEphem[fbInd]
+        self.bEphem = self.bEphem[acInd]
         return
 
+    def _filter_windows(self, windows):
+        """
+        This method filters the two (common time) ephemeris files to the
+        times inside the lapping event windows, and returns the indices of
+        the times that were kept.
+        """
+        idx = np.where(lap_recurrence.in_windows(
+                        self.aEphem.datetime64(), windows))[0]
+        self.aEphem = self.aEphem[idx]
+        self.bEphem = self.bEphem[idx]
+        return idx
         
     def _haversine(self, X1, X2):
         """
@@ -194,6 +204,7 @@ class CalcDist():
         return R*s
         
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
     SC_B = 'REACH'
     for SC_A in ['FU3', 'FU4']:
         DATE_RANGE = [datetime(2019, 1, 21), datetime(2019, 2, 23)]
@@ -1,97 +1,102 @@
 # This script calculates the good time intervals to target.
-from matplotlib.dates import date2num
-from datetime import timedelta
-import dateutil.parser
 import numpy as np
 import csv
 
+import lap_recurrence
+import lap_index
+from ephemeris import Ephem, parse_times
+
 class LapTimes:
-    def __init__(self, sc_a, sc_b, sepPath):
+    def __init__(self, sc_a, sc_b, sepPath, windows=None):
+        """
+        This class finds the lapping events in a separation file. If 
+        windows is a (start times, end times) tuple, e.g. from 
+        lap_recurrence.LapRecurrence.predict(), the separation is only 
+        evaluated inside those windows.
+        """
         self.sc_a = sc_a
         self.sc_b = sc_b
-        self.sepData = self._load_sep(sepPath)
+        self.sepData = self._load_sep(sepPath, windows)
         return     
 
     def calcLapTimes(self, thresh=500):
         """ 
         This method calculates the start and end times when the two
-        spacecraft where within thresh km separation.
+        spacecraft where within thresh km separation, with one vectorized
+        scan of the separation.
         """
-        sepInd = np.where(np.abs(self.sepData['d']) < thresh)[0]
-        sepInd = np.append(sepInd, -9999)
-        conv = np.convolve([1, -1], sepInd, mode = 'valid') - 1
-        consecutiveFlag = np.where(conv != 0)[0] + 1
-        startInd = np.insert(consecutiveFlag, 0, 0)[:-1]
-        endInd = np.insert(consecutiveFlag, len(consecutiveFlag), len(sepInd)-1)[:-1]
-        self.startTime = self.sepData['dateTime'][sepInd[startInd]]
-        self.endTime = self.sepData['dateTime'][sepInd[endInd-1]]
+        startInd, endInd, iMin = lap_index.find_laps(
+                                    np.abs(self.sepData['d']), thresh)
+        startTime = self.sepData['time'][startInd]
+        endTime = self.sepData['time'][endInd]
         
         # This is a python indexing thing, but when start and end 
         # indicies are off by 1, the start/end time is the same.
         # So here I am arbitarily adding a minute.
-        nStart = date2num(self.startTime)
-        nEnd = date2num(self.endTime)
-        i_same = np.where(np.isin(nEnd, nStart))[0]
-        for i in i_same:
-            self.endTime[i] += timedelta(minutes=1)
+        i_same = np.where(np.isin(endTime, startTime))[0]
+        endTime[i_same] += 60*10**6
+        self.startTime = startTime.view('datetime64[us]')
+        self.endTime = endTime.view('datetime64[us]')
         # Calc lapping event duration (in minutes)    
-        self.duration = np.array([(t_f - t_i).seconds/60 for t_i, t_f 
-                        in zip(self.startTime, self.endTime)])
+        self.duration = (endTime - startTime)/(60*10**6)
         
         # Calculate min separation
-        self._calc_min_sep(sepInd[startInd], sepInd[endInd-1])
+        self._calc_min_sep(iMin)
         return
 
     def saveData(self, fPath):
         with open(fPath, 'w', newline='') as f:
             w = csv.writer(f)
-            w.writerow(['lapStartTime', 'lapEndTime', 
-                        'lapDuration [min]', 'minDist [km]', 
-                        '{}_L_at_min'.format(self.sc_a), 
-                        '{}_L_at_min'.format(self.sc_b)])
-            zTuple = zip(self.startTime, self.endTime, self.duration,
+            w.writerow(lap_header(self.sc_a, self.sc_b))
+            zTuple = zip(self.startTime.astype(object), 
+                         self.endTime.astype(object), self.duration,
                          self.dmin, self.scALmin, self.scBLmin)
             for z in zTuple:
                 w.writerow([*z])
             return
 
-    def _calc_min_sep(self, startInd, endInd):
+    def _calc_min_sep(self, iMin):
         """ 
-        For each lapping event, this method calculates the closest separation.
+        For each lapping event, this method saves the closest separation 
+        and the L shells at that time, given the index of the closest 
+        separation.
         """
-        self.dmin = np.nan*np.zeros(len(startInd))
-        self.scALmin = np.nan*np.zeros(len(startInd))
-        self.scBLmin = np.nan*np.zeros(len(startInd))
-        # To avoid a crash in case there is only one data point below threshold.
-        # Should not effect the results.
-        endInd += 1 
-        for i, (sI, eI) in enumerate(zip(startInd, endInd)):
-            self.dmin[i] = np.min(self.sepData['d'][sI:eI])
-            iMin = np.argmin(self.sepData['d'][sI:eI])+sI
-
-            self.scALmin[i] = self.sepData['L_{}'.format(self.sc_a)][iMin]
-            self.scBLmin[i] = self.sepData['L_{}'.format(self.sc_b)][iMin]
+        self.dmin = self.sepData['d'][iMin]
+        self.scALmin = self.sepData['L_{}'.format(self.sc_a)][iMin]
+        self.scBLmin = self.sepData['L_{}'.format(self.sc_b)][iMin]
         return
 
-    def _load_sep(self, path):
+    def _load_sep(self, path, windows=None):
         """ This method loads in the separation file """
         with open(path) as f:
             r = csv.reader(f)
             keys = next(r)
             rawData = np.array(list(r))
-        sepData = {}
+        sepData = Ephem(parse_times(rawData[:, keys.index('dateTime')]), {})
         for (i, key) in enumerate(keys):
             if key == 'dateTime':
-                sepData['dateTime'] = np.array([dateutil.parser.parse(t)
-                                for t in rawData[:, i]])
+                continue
             #elif 'dist_in_track' in key:
             #    sepData['d'] = np.array([float(d) for d in rawData[:, i]])  
             else:
-                sepData[key] = np.array([float(d) for d in rawData[:, i]]) 
-        sepData['d'] = np.sqrt(sepData['dist_in_track [km]']**2 + 
-                        sepData['dist_cross_track [km]']**2)
+                sepData[key] = rawData[:, i].astype(np.float64)
+        if windows is None:
+            inWindow = np.ones(len(sepData), dtype=bool)
+        else:
+            inWindow = lap_recurrence.in_windows(sepData.datetime64(), windows)
+        # Samples outside of the windows are never below any threshold.
+        sepData['d'] = np.inf*np.ones(len(sepData))
+        sepData['d'][inWindow] = np.sqrt(
+                        sepData['dist_in_track [km]'][inWindow]**2 + 
+                        sepData['dist_cross_track [km]'][inWindow]**2)
         return sepData
 
+def lap_header(sc_a, sc_b):
+    """ This function returns the header of the lap times file. """
+    return ['lapStartTime', 'lapEndTime', 'lapDuration [min]', 
+            'minDist [km]', '{}_L_at_min'.format(sc_a), 
+            '{}_L_at_min'.format(sc_b)]
+
 if __name__ == '__main__':
     from datetime import date
     sc = ['FU3', 'REACH']
@@ -104,7 +109,8 @@ if __name__ == '__main__':
 
     L = LapTimes(*sc, '/home/mike/research/leo-lapping-events/data/dist/'
                 '20190125_{}_REACH_dist.csv'.format(sc[0]))
-    L.calcLapTimes(thresh=1000)
-    L.saveData('./data/lap_times/20190125_{}_REACH_lap_times.csv'.format(
-                sc[0]))
+    for thresh in [500, 1000]:
+        L.calcLapTimes(thresh=thresh)
+        L.saveData('./data/lap_times/20190125_{}_REACH_lap_times_{}km_thresh.csv'.format(
+                    sc[0], thresh))
     
@@ -0,0 +1,101 @@
+# This script calculates approximate L shells and MLT with a centered or
+# eccentric dipole field. It is orders of magnitude faster than IRBEM, so
+# it is used to screen lapping events before running the full models.
+import numpy as np
+
+from ephemeris import to_epoch
+
+Re = 6371.2 # km, IGRF reference radius
+# WGS84 ellipsoid
+A_WGS84 = 6378.137 # km
+F_WGS84 = 1/298.257223563
+
+# IGRF-13 degree 1 and 2 coefficients (nT) at 2020.0 and their secular
+# variation (nT/year).
+IGRF_EPOCH = np.datetime64('2020-01-01', 'us')
+IGRF = {'g10':(-29404.8, 5.7), 'g11':(-1450.9, 7.4), 'h11':(4652.5, -25.9),
+        'g20':(-2499.6, -11.0), 'g21':(2982.0, -7.0), 'h21':(-2991.6, -30.2),
+        'g22':(1677.0, -2.1), 'h22':(-734.6, -22.4)}
+
+def calc_lm_mlt(time, alt, lat, lon, eccentric=True):
+    """
+    This function calculates the dipole L shell and MLT for arrays of
+    times (datetimes, datetime64s, or epoch times) and geodetic
+    positions (alt in km, lat and lon in degrees). The dipole
+    coefficients are evaluated at the mean time. If eccentric is True,
+    the dipole is offset from the Earth's center using the quadrupole
+    IGRF terms, which is a better approximation of the real field at LEO.
+    """
+    t = to_epoch(time)
+    c = _igrf_coeffs(np.mean(t))
+    r = _geodetic_to_geo(np.asarray(alt, dtype=float),
+                        np.asarray(lat, dtype=float),
+                        np.asarray(lon, dtype=float))
+    B0 = np.sqrt(c['g10']**2 + c['g11']**2 + c['h11']**2)
+    # The dipole axis points to the northern geomagnetic pole.
+    zm = -np.array([c['g11'], c['h11'], c['g10']])/B0
+    if eccentric:
+        r = r - _eccentric_offset(c, B0)
+
+    # Magnetic coordinate frame.
+    ym = np.cross([0, 0, 1], zm)
+    ym /= np.linalg.norm(ym)
+    xm = np.cross(ym, zm)
+
+    rNorm = np.linalg.norm(r, axis=1)
+    sinMlat = r @ zm/rNorm
+    L = rNorm/Re/(1 - sinMlat**2)
+
+    sun = _sun_geo(t)
+    phi = np.arctan2(r @ ym, r @ xm)
+    phiSun = np.arctan2(sun @ ym, sun @ xm)
+    MLT = np.mod(np.rad2deg(phi - phiSun)/15 + 12, 24)
+    return L, MLT
+
+def _igrf_coeffs(t):
+    """ Returns the IGRF coefficients at epoch time t. """
+    years = (t - IGRF_EPOCH.astype(np.int64))/(365.25*86400*1E6)
+    return {key:val + years*sv for (key, (val, sv)) in IGRF.items()}
+
+def _eccentric_offset(c, B0):
+    """
+    Returns the eccentric dipole center (km) in GEO coordinates, from the
+    degree 1 and 2 coefficients (Fraser-Smith, 1987).
+    """
+    L0 = 2*c['g10']*c['g20'] + np.sqrt(3)*(c['g11']*c['g21'] + c['h11']*c['h21'])
+    L1 = -c['g11']*c['g20'] + np.sqrt(3)*(c['g10']*c['g21'] +
+                                c['g11']*c['g22'] + c['h11']*c['h22'])
+    L2 = -c['h11']*c['g20'] + np.sqrt(3)*(c['g10']*c['h21'] -
+                                c['h11']*c['g22'] + c['g11']*c['h22'])
+    E = (L0*c['g10'] + L1*c['g11'] + L2*c['h11'])/(4*B0**2)
+    return Re*np.array([L1 - c['g11']*E, L2 - c['h11']*E,
+                        L0 - c['g10']*E])/(3*B0**2)
+
+def _geodetic_to_geo(alt, lat, lon):
+    """ Converts geodetic coordinates to N*3 GEO (ECEF) positions in km. """
+    lat = np.deg2rad(lat)
+    lon = np.deg2rad(lon)
+    e2 = F_WGS84*(2 - F_WGS84)
+    N = A_WGS84/np.sqrt(1 - e2*np.sin(lat)**2)
+    return np.stack([(N + alt)*np.cos(lat)*np.cos(lon),
+                     (N + alt)*np.cos(lat)*np.sin(lon),
+                     (N*(1 - e2) + alt)*np.sin(lat)], axis=1)
+
+def _sun_geo(t):
+    """
+    Returns the N*3 unit vectors to the Sun in GEO coordinates at epoch
+    times t, using the low precision solar coordinates from the
+    Astronomical Almanac (good to ~0.01 deg).
+    """
+    n = (t - np.datetime64('2000-01-01T12:00', 'us').astype(np.int64))/(86400*1E6)
+    meanLon = np.deg2rad(280.460 + 0.9856474*n)
+    g = np.deg2rad(357.528 + 0.9856003*n)
+    eclLon = meanLon + np.deg2rad(1.915*np.sin(g) + 0.020*np.sin(2*g))
+    obliq = np.deg2rad(23.439 - 4E-7*n)
+    # Rotate from GEI to GEO with the Greenwich mean sidereal time.
+    gmst = np.deg2rad(280.46061837 + 360.98564736629*n)
+    x = np.cos(eclLon)
+    y = np.cos(obliq)*np.sin(eclLon)
+    return np.stack([np.cos(gmst)*x + np.sin(gmst)*y,
+                     -np.sin(gmst)*x + np.cos(gmst)*y,
+                     np.sin(obliq)*np.sin(eclLon)], axis=1)
@@ -0,0 +1,119 @@
+# This script defines the compact ephemeris type that is passed around by
+# the lapping event code. Times are stored as int64 microseconds since the
+# Unix epoch and only converted to datetimes for saving or plotting.
+import numpy as np
+
+def to_epoch(times):
+    """
+    This function converts datetime(s), datetime64(s), or ISO time
+    strings to int64 microseconds since the Unix epoch.
+    """
+    return np.asarray(times, dtype='datetime64[us]').astype(np.int64)
+
+def from_epoch(times):
+    """
+    This function converts int64 epoch time(s) back to datetime object(s).
+    """
+    return np.asarray(times, dtype=np.int64).astype(
+                            'datetime64[us]').astype(object)[()]
+
+def parse_times(timeStrs):
+    """
+    This function parses an array of time strings into int64 epoch times.
+    NumPy's ISO 8601 parser is tried first, and dateutil is the fallback
+    for any other time format.
+    """
+    try:
+        return to_epoch(timeStrs)
+    except ValueError:
+        import dateutil.parser
+        return to_epoch([dateutil.parser.parse(t) for t in timeStrs])
+
+class Ephem():
+    __slots__ = ('time', 'cols', 'attrs')
+
+    def __init__(self, time, cols, attrs=None):
+        """
+        This class holds an ephemeris (or any time series) as a contiguous
+        int64 epoch time array and a dictionary of typed column arrays that
+        share the time axis. Indexing with a column name returns that
+        column ('time' returns the times), and indexing with anything else
+        (slice, index array, boolean mask) returns a new Ephem with every
+        column indexed the same way. Basic slices are views, so they are
+        cheap and writes to them update the parent. attrs is a dictionary
+        of metadata (e.g. element labels) shared by all views.
+        """
+        self.time = np.asarray(time, dtype=np.int64)
+        self.cols = cols
+        self.attrs = {} if attrs is None else attrs
+        return
+
+    @classmethod
+    def concatenate(cls, ephems):
+        """ This method joins a list of Ephem objects in time. """
+        cols = {key:np.concatenate([e.cols[key] for e in ephems])
+                for key in ephems[0].cols}
+        return cls(np.concatenate([e.time for e in ephems]), cols,
+                    ephems[0].attrs)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return key == 'time' or key in self.cols
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key == 'time':
+                return self.time
+            return self.cols[key]
+        return Ephem(self.time[key],
+                    {k:v[key] for (k, v) in self.cols.items()}, self.attrs)
+
+    def __setitem__(self, key, value):
+        if key == 'time':
+            self.time = np.asarray(value, dtype=np.int64)
+        else:
+            self.cols[key] = value
+        return
+
+    def keys(self):
+        return ['time', *self.cols.keys()]
+
+    def window_index(self, tStart, tEnd):
+        """
+        This method returns the (start, end) slice indices of the times
+        strictly between tStart and tEnd (datetimes or epoch times).
+        The times must be sorted.
+        """
+        i0 = np.searchsorted(self.time, self._epoch(tStart), side='right')
+        i1 = np.searchsorted(self.time, self._epoch(tEnd), side='left')
+        return i0, max(i0, i1)
+
+    def window(self, tStart, tEnd):
+        """
+        This method returns a view of the ephemeris strictly between
+        tStart and tEnd.
+        """
+        i0, i1 = self.window_index(tStart, tEnd)
+        return self[i0:i1]
+
+    def datetime64(self):
+        """
+        This method returns a datetime64 view of the times. Matplotlib
+        plots these directly, so the conversion to its internal time
+        format only happens at plot time.
+        """
+        return self.time.view('datetime64[us]')
+
+    def dateTime(self):
+        """ This method returns the times as datetime objects. """
+        return self.datetime64().astype(object)
+
+    def _epoch(self, t):
+        if isinstance(t, (int, np.integer)):
+            return t
+        return to_epoch(t)
@@ -0,0 +1,213 @@
+# This script keeps a SQLite catalog of the lapping events from all of the
+# lap times files, for every spacecraft pair and date range.
+import csv
+import os
+import re
+import sqlite3
+import numpy as np
+
+from ephemeris import Ephem, to_epoch, parse_times
+import lap_recurrence
+
+class LapCatalog():
+    def __init__(self, dbPath):
+        """
+        This class ingests the lapping events found by LapTimes (or saved
+        in its lap times csv files) into a SQLite database indexed on the
+        spacecraft pair and start time, the minimum distance, and the L
+        shell, and queries them. Times are stored as int64 epoch times.
+        An event is unique by its pair, threshold, and start time, so 
+        ingesting the same events again replaces them.
+        """
+        self.dbPath = dbPath
+        self.conn = sqlite3.connect(dbPath)
+        self._create_tables()
+        return
+
+    def ingest_lap_times(self, L, thresh=None, source=None):
+        """
+        This method adds the events of a LapTimes object (after
+        calcLapTimes was run). If source (e.g. the lap times file
+        name) is given, any events previously ingested from that source
+        are replaced.
+        """
+        self._ingest(L.sc_a, L.sc_b, to_epoch(L.startTime),
+                    to_epoch(L.endTime), L.duration, L.dmin, L.scALmin,
+                    L.scBLmin, thresh, source)
+        return
+
+    def ingest_csv(self, fPath, thresh=None):
+        """
+        This method adds the events from a lap times csv file. The
+        spacecraft names are taken from the header and, if thresh is not
+        given, the threshold is taken from the file name
+        (e.g. *_500km_thresh*.csv) when possible.
+        """
+        with open(fPath) as f:
+            r = csv.reader(f)
+            keys = next(r)
+            rawData = np.array(list(r)).reshape(-1, len(keys))
+        sc_a, sc_b = [key.replace('_L_at_min', '') for key in keys[4:6]]
+        if thresh is None:
+            match = re.search(r'(\d+)km_thresh', os.path.basename(fPath))
+            thresh = float(match.group(1)) if match else None
+        self._ingest(sc_a, sc_b, parse_times(rawData[:, 0]),
+                    parse_times(rawData[:, 1]), *rawData[:, 2:6].astype(float).T,
+                    thresh, os.path.abspath(fPath))
+        return
+
+    def has_source(self, fPath):
+        """ This method checks if a lap times file was already ingested. """
+        cur = self.conn.execute('SELECT 1 FROM laps WHERE source = ? LIMIT 1',
+                                (os.path.abspath(fPath),))
+        return cur.fetchone() is not None
+
+    def query(self, sc_a=None, sc_b=None, startDate=None, endDate=None,
+              maxDist=None, minL=None, maxL=None, thresh=None, source=None,
+              minLb=None, maxLb=None):
+        """
+        This method returns the lapping events that match all of the
+        given criteria, sorted by start time, as an Ephem with the start
+        times as its times. The pair matches in either order, and the
+        returned sc_a/sc_b and L_a/L_b columns are in the requested order.
+        minL and maxL are applied to sc_a's L shell at the minimum 
+        separation, minLb and maxLb to sc_b's, and source restricts the 
+        events to the ones ingested from one lap times file. For example,
+        the FU3-REACH events closer than 200 km between L=4 and 8 in March
+        2019 are query('FU3', 'REACH', datetime(2019, 3, 1), 
+        datetime(2019, 4, 1), maxDist=200, minL=4, maxL=8).
+        """
+        # The SQL expressions (and their parameters) of the requested 
+        # spacecraft's L shells, since the pairs are stored in sorted order.
+        if sc_a is not None and sc_b is not None:
+            pair = [('sc_a = ?', [min(sc_a, sc_b)]), ('sc_b = ?', [max(sc_a, sc_b)])]
+            L_a, L_b = (('L_b', []), ('L_a', [])) if sc_a > sc_b else \
+                        (('L_a', []), ('L_b', []))
+        elif sc_a is not None or sc_b is not None:
+            sc = sc_a if sc_a is not None else sc_b
+            pair = [('? IN (sc_a, sc_b)', [sc])]
+            L_sc = ('(CASE WHEN sc_a = ? THEN L_a ELSE L_b END)', [sc])
+            L_other = ('(CASE WHEN sc_a = ? THEN L_b ELSE L_a END)', [sc])
+            L_a, L_b = (L_sc, L_other) if sc_a is not None else (L_other, L_sc)
+        else:
+            pair = []
+            L_a, L_b = ('L_a', []), ('L_b', [])
+
+        # (condition, condition parameters, value) of the other criteria.
+        conditions = [('start_time >= ?', [], startDate), 
+                    ('start_time < ?', [], endDate), ('min_dist < ?', [], maxDist), 
+                    ('thresh = ?', [], thresh), ('source = ?', [], source), 
+                    (L_a[0] + ' > ?', L_a[1], minL), (L_a[0] + ' < ?', L_a[1], maxL), 
+                    (L_b[0] + ' > ?', L_b[1], minLb), (L_b[0] + ' < ?', L_b[1], maxLb)]
+        where = [condition for (condition, _) in pair]
+        params = [p for (_, value) in pair for p in value]
+        for (condition, conditionParams, value) in conditions:
+            if value is None:
+                continue
+            if condition.startswith('start_time'):
+                value = int(to_epoch(value))
+            elif condition.startswith('source'):
+                value = os.path.abspath(value)
+            where.append(condition)
+            params.extend([*conditionParams, value])
+        sql = ('SELECT start_time, end_time, duration, min_dist, L_a, L_b, '
+               'sc_a, sc_b FROM laps')
+        if len(where):
+            sql += ' WHERE ' + ' AND '.join(where)
+        rows = self.conn.execute(sql + ' ORDER BY start_time', params).fetchall()
+
+        cols = [np.array(col) for col in zip(*rows)] if len(rows) else [[]]*8
+        laps = Ephem(np.array(cols[0], dtype=np.int64), {
+                    'endTime':np.array(cols[1], dtype=np.int64),
+                    'duration':np.array(cols[2], dtype=float),
+                    'minDist':np.array(cols[3], dtype=float),
+                    'L_a':np.array(cols[4], dtype=float),
+                    'L_b':np.array(cols[5], dtype=float),
+                    'sc_a':np.array(cols[6], dtype=object),
+                    'sc_b':np.array(cols[7], dtype=object)})
+        # Put the pairs back in the requested order.
+        if sc_a is not None:
+            flip = laps['sc_a'] != sc_a
+        elif sc_b is not None:
+            flip = laps['sc_b'] != sc_b
+        else:
+            flip = np.zeros(len(laps), dtype=bool)
+        for (a, b) in [('sc_a', 'sc_b'), ('L_a', 'L_b')]:
+            laps[a][flip], laps[b][flip] = laps[b][flip], laps[a][flip]
+        return laps
+
+    def recurrence(self, sc_a, sc_b, **kwargs):
+        """
+        This method returns a LapRecurrence of one spacecraft pair's
+        events. The kwargs are passed to query().
+        """
+        laps = self.query(sc_a, sc_b, **kwargs)
+        return lap_recurrence.LapRecurrence(laps.datetime64(),
+                                    laps['endTime'].view('datetime64[us]'))
+
+    def close(self):
+        self.conn.close()
+        return
+
+    def _ingest(self, sc_a, sc_b, startTime, endTime, duration, dmin,
+                scALmin, scBLmin, thresh, source):
+        """ 
+        This method inserts the events in one transaction. The pair is 
+        stored in sorted order so that it can be matched in either order.
+        """
+        if sc_a > sc_b:
+            sc_a, sc_b, scALmin, scBLmin = sc_b, sc_a, scBLmin, scALmin
+        rows = zip(
+            [sc_a]*len(startTime), [sc_b]*len(startTime),
+            [thresh]*len(startTime), np.asarray(startTime).tolist(),
+            np.asarray(endTime).tolist(), np.asarray(duration, dtype=float).tolist(),
+            np.asarray(dmin, dtype=float).tolist(),
+            np.asarray(scALmin, dtype=float).tolist(),
+            np.asarray(scBLmin, dtype=float).tolist(), [source]*len(startTime))
+        with self.conn:
+            if source is not None:
+                self.conn.execute('DELETE FROM laps WHERE source = ?', (source,))
+            self.conn.executemany('INSERT OR REPLACE INTO laps VALUES '
+                                '(?,?,?,?,?,?,?,?,?,?)', rows)
+        return
+
+    def _create_tables(self):
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS laps ('
+                'sc_a TEXT, sc_b TEXT, thresh REAL, start_time INTEGER, '
+                'end_time INTEGER, duration REAL, min_dist REAL, L_a REAL, '
+                'L_b REAL, source TEXT)')
+            # Sort the pairs ingested before they were stored in order.
+            self.conn.execute('UPDATE OR REPLACE laps SET sc_a = sc_b, '
+                'sc_b = sc_a, L_a = L_b, L_b = L_a WHERE sc_a > sc_b')
+            # UNIQUE treats NULLs as distinct, so a missing threshold is 
+            # indexed as -1. Catalogs made before this index existed may 
+            # have duplicate events, so only the last ingested one is kept.
+            hasUnique = self.conn.execute('SELECT 1 FROM sqlite_master WHERE '
+                        "type = 'index' AND name = 'laps_event'").fetchone()
+            if hasUnique is None:
+                self.conn.execute('DELETE FROM laps WHERE rowid NOT IN ('
+                    'SELECT MAX(rowid) FROM laps GROUP BY sc_a, sc_b, '
+                    'IFNULL(thresh, -1), start_time)')
+                self.conn.execute('CREATE UNIQUE INDEX laps_event ON laps '
+                    '(sc_a, sc_b, IFNULL(thresh, -1), start_time)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS laps_pair_start '
+                            'ON laps (sc_a, sc_b, start_time)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS laps_min_dist '
+                            'ON laps (min_dist)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS laps_L_a ON laps (L_a)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS laps_L_b ON laps (L_b)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS laps_source '
+                            'ON laps (source)')
+        return
+
+if __name__ == '__main__':
+    import glob
+    from datetime import datetime
+    catalog = LapCatalog('./data/lap_catalog.db')
+    for fPath in glob.glob('./data/lap_times/*.csv'):
+        catalog.ingest_csv(fPath)
+    laps = catalog.query('FU3', 'REACH', datetime(2019, 3, 1),
+                        datetime(2019, 4, 1), maxDist=200, minL=4, maxL=8)
+    for z in zip(laps.dateTime(), laps['minDist'], laps['L_a']):
+        print(*z)
@@ -1,27 +1,17 @@
 # This script calculates how often close lapping events occur.
 
 import numpy as np
-import csv
-import dateutil.parser
-from datetime import datetime, timedelta
 import matplotlib.pyplot as plt
 
-fname = './data/2018-04-11_2018-06-11_FU4_AC6A_lap_times_500km_thresh_v2.csv'
+import lap_catalog
 
-with open(fname) as f:
-    r = csv.reader(f)
-    keys = next(r)
-    rawData = np.array(list(r))
+fname = './data/2018-04-11_2018-06-11_FU4_AC6A_lap_times_500km_thresh_v2.csv'
 
-lapData = {}
-for i, key in enumerate(keys):
-    if 'Time' in key:
-        lapData[key] = np.array([dateutil.parser.parse(t) 
-                                for t in rawData[:, i]])
-    else:
-        lapData[key] = np.array(rawData[:, i], dtype=float)
-z = zip(lapData['lapStartTime'][1:], lapData['lapStartTime'][:-1])
-dt = [(tii - ti).total_seconds() for (tii, ti) in z]
+catalog = lap_catalog.LapCatalog('./data/lap_catalog.db')
+if not catalog.has_source(fname):
+    catalog.ingest_csv(fname)
+lapData = catalog.query(source=fname)
+dt = np.diff(lapData['time'])/1E6
 
 plt.hist(dt, bins=np.linspace(28000, 34000))
-plt.show()
\ No newline at end of file
+plt.show()
@@ -0,0 +1,201 @@
+# This script finds the lapping events in a separation time series, either
+# with one vectorized scan per threshold, or with a precomputed index that
+# is looked up for each threshold without rescanning the series.
+import numpy as np
+
+# Building a LapIndex takes about as long as this many find_laps() scans,
+# so the index is only used for longer threshold sweeps.
+INDEX_MIN_THRESHOLDS = 100
+# Block size of the LapIndex range maximum structure.
+RMQ_BLOCK = 64
+
+def find_laps_many(d, thresholds):
+    """
+    This function returns a dictionary of threshold: find_laps(d, threshold)
+    for all of the thresholds. Short threshold lists are scanned one at a
+    time, and a LapIndex is built for longer ones.
+    """
+    if len(thresholds) < INDEX_MIN_THRESHOLDS:
+        return {thresh:find_laps(d, thresh) for thresh in thresholds}
+    return LapIndex(d).query_many(thresholds)
+
+def find_laps(d, thresh):
+    """
+    This function returns the start indices, end indices (inclusive), and
+    the indices of the minimum separation of the lapping events (maximal
+    runs of d < thresh) with one vectorized scan of d. This is the fast
+    way to find the events for a single threshold.
+    """
+    d = np.asarray(d, dtype=float)
+    below = d < thresh # NaN separations are never below a threshold.
+    edges = np.diff(np.concatenate(([0], below.view(np.int8), [0])))
+    lo = np.where(edges == 1)[0]
+    hi = np.where(edges == -1)[0] - 1
+    # Find each event's minimum, and then the first sample at that minimum.
+    idx = np.where(below)[0]
+    nSamples = hi - lo + 1
+    dBelow = d[idx]
+    if len(lo):
+        dMin = np.minimum.reduceat(dBelow, np.cumsum(nSamples) - nSamples)
+    else:
+        dMin = dBelow
+    atMin = np.where(dBelow == np.repeat(dMin, nSamples))[0]
+    event = np.repeat(np.arange(len(lo)), nSamples)[atMin]
+    first = np.where(np.diff(event, prepend=-1) != 0)[0]
+    return lo, hi, idx[atMin[first]]
+
+class LapIndex():
+    def __init__(self, d):
+        """
+        This class indexes the separation series d. A lapping event at
+        threshold T is a maximal run of samples with d < T. Every such run
+        is the span of a node of the max-Cartesian tree of d: node i's span
+        is a run at T if d[i] < T <= d[parent of i]. The tree is built
+        once, and each node's span, argmin, and threshold interval
+        (birth, death] are saved. The nodes are sorted by birth, and a
+        range maximum structure over their deaths reports the nodes with
+        birth < T <= death without reading the others (a priority search),
+        so a query only reads O(k) nodes for k events. The build is a 
+        Python loop over d, so the index only pays off when many 
+        thresholds are queried (see find_laps_many()).
+        """
+        self.d = np.asarray(d, dtype=float)
+        # NaN separations are never below a threshold, same as inf.
+        self.d = np.where(np.isnan(self.d), np.inf, self.d)
+        self._build()
+        return
+
+    def query(self, thresh):
+        """
+        This method returns the start indices, end indices (inclusive), and
+        the indices of the minimum separation of the lapping events below
+        thresh, in time order. The nodes born below thresh are a prefix
+        of the birth order, and the ones in it that are still alive at 
+        thresh are found by splitting that range at its maximum death until
+        the maximum is below thresh. This takes O(log n + k*RMQ_BLOCK) 
+        time, plus sorting the k events in time.
+        """
+        a = np.zeros(1, dtype=int)
+        b = np.searchsorted(self._birth, thresh, side='left').reshape(1)
+        found = [np.zeros(0, dtype=int)]
+        while True:
+            nonEmpty = a < b
+            a, b = a[nonEmpty], b[nonEmpty]
+            if len(a) == 0:
+                break
+            m = self._argmax_death(a, b)
+            alive = self._death[m] >= thresh
+            a, b, m = a[alive], b[alive], m[alive]
+            found.append(m)
+            a, b = np.concatenate((a, m+1)), np.concatenate((m, b))
+        nodes = np.sort(self._order[np.concatenate(found)])
+        return self.lo[nodes], self.hi[nodes], self.iMin[nodes]
+
+    def query_many(self, thresholds):
+        """
+        This method returns a dictionary of threshold: query(threshold)
+        for all of the thresholds.
+        """
+        return {thresh:self.query(thresh) for thresh in thresholds}
+
+    def _build(self):
+        """
+        This method builds the max-Cartesian tree with a stack. A node's
+        parent is only final when it is popped, so that is when its
+        death threshold and subtree argmin are filled in.
+        """
+        d = self.d.tolist()
+        n = len(d)
+        lo = [0]*n
+        hi = [0]*n
+        death = [np.inf]*n
+        iMin = list(range(n))
+
+        def attach(parent, child):
+            death[child] = d[parent]
+            if d[iMin[child]] < d[iMin[parent]]:
+                iMin[parent] = iMin[child]
+            return
+
+        stack = []
+        for i in range(n):
+            last = -1
+            while stack and d[stack[-1]] < d[i]:
+                j = stack.pop()
+                hi[j] = i-1
+                if last != -1: # The previously popped node is j's right child.
+                    attach(j, last)
+                last = j
+            if last != -1: # The last popped node is i's left child.
+                attach(i, last)
+            lo[i] = stack[-1]+1 if stack else 0
+            stack.append(i)
+        # The nodes left on the stack form the right spine of the tree.
+        last = -1
+        for j in reversed(stack):
+            hi[j] = n-1
+            if last != -1:
+                attach(j, last)
+            last = j
+
+        self.lo = np.array(lo, dtype=int)
+        self.hi = np.array(hi, dtype=int)
+        self.iMin = np.array(iMin, dtype=int)
+        self._order = np.argsort(self.d, kind='stable')
+        self._birth = self.d[self._order]
+        self._death = np.array(death)[self._order]
+        self._build_rmq()
+        return
+
+    def _build_rmq(self):
+        """
+        This method builds the range maximum structure over the deaths (in
+        birth order): the argmax of each RMQ_BLOCK block, and a sparse 
+        table over the blocks where row j is the argmax of 2^j blocks.
+        """
+        nBlocks = -(-len(self._death)//RMQ_BLOCK)
+        padded = -np.inf*np.ones(nBlocks*RMQ_BLOCK)
+        padded[:len(self._death)] = self._death
+        blockMax = (np.argmax(padded.reshape(nBlocks, RMQ_BLOCK), axis=1) + 
+                    RMQ_BLOCK*np.arange(nBlocks))
+        self._sparse = [blockMax]
+        while 2**len(self._sparse) <= nBlocks:
+            prev = self._sparse[-1]
+            h = 2**(len(self._sparse)-1)
+            left, right = prev[:-h], prev[h:]
+            self._sparse.append(np.where(self._death[right] > self._death[left], 
+                                        right, left))
+        return
+
+    def _argmax_death(self, a, b):
+        """
+        This method returns the index of the maximum death in each of the 
+        (non-empty) birth order ranges [a, b). The partial blocks at the 
+        ends are scanned, and the full blocks use the sparse table.
+        """
+        candidates = [self._scan_death(a, np.minimum(b, (a//RMQ_BLOCK+1)*RMQ_BLOCK)),
+                    self._scan_death(np.maximum(a, (b//RMQ_BLOCK)*RMQ_BLOCK), b)]
+        b0, b1 = a//RMQ_BLOCK+1, b//RMQ_BLOCK # The full blocks are [b0, b1).
+        full = np.where(b1 > b0)[0]
+        level = np.floor(np.log2(np.maximum(b1 - b0, 1))).astype(int)
+        for j in np.unique(level[full]):
+            i = full[level[full] == j]
+            for blocks in [b0[i], b1[i] - 2**j]:
+                c = -np.ones(len(a), dtype=int)
+                c[i] = self._sparse[j][blocks]
+                candidates.append(c)
+        candidates = np.array(candidates)
+        vals = np.where(candidates >= 0, self._death[candidates], -np.inf)
+        return candidates[np.argmax(vals, axis=0), np.arange(len(a))]
+
+    def _scan_death(self, a, b):
+        """
+        This method returns the index of the maximum death in each of the
+        ranges [a, b) that are at most RMQ_BLOCK long, or -1 if empty.
+        """
+        idx = a[:, np.newaxis] + np.arange(RMQ_BLOCK)
+        inRange = idx < b[:, np.newaxis]
+        vals = np.where(inRange, self._death[np.minimum(idx, len(self._death)-1)], 
+                        -np.inf)
+        j = np.argmax(vals, axis=1)
+        return np.where(inRange[np.arange(len(a)), j], a + j, -1)
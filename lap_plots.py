@@ -4,28 +4,32 @@
 import csv
 import matplotlib.pyplot as plt
 import matplotlib.dates
-import dateutil.parser
 import numpy as np
 from datetime import datetime, timedelta
 import sys
 import os
+import itertools
+import functools
 
-import spacepy.datamodel
-import spacepy.time
+from ephemeris import Ephem, to_epoch, from_epoch, parse_times
+from prefetch import Prefetcher
+import read_fb_data
 
+# read_ac_data and make_magephem (IRBEM) are imported when first used.
 sys.path.insert(0, '/home/mike/research/mission-tools/ac6')
-import read_ac_data
-import IRBEM
 
 class Lap():
     def __init__(self, sepPath, fb_id, ac_id, fbDir=None, acDir=None,
-                 startDate=None, endDate=None):
+                 startDate=None, endDate=None, magModel='OPQ77'):
         """
         This class handles the data management and plotting of the 
         FIREBIRD-II - AC6 lapping events. This class needs 
         A) access to the FIREBIRD HiRes data 
         B) access to AC6's 10Hz or survey data
         C) csv separation file.
+        magModel is the model used for the FIREBIRD L and MLT, either 
+        an IRBEM kext or one of make_magephem.DIPOLE_MODELS for a fast
+        approximation.
         """
         self.fb_id = fb_id
         self.ac_id = ac_id
@@ -33,6 +37,7 @@ class Lap():
 
         self.startDate = startDate
         self.endDate = endDate
+        self.magModel = magModel
 
         if self.fbDir is None:
             self.fbDir = ('/home/mike/research/firebird/Datafiles/'
@@ -41,19 +46,25 @@ class Lap():
         self._load_sep(sepPath) # Load separation file.
         return
 
-    def plot_lap_event(self, tRange, acDtype='10Hz', lag=None):
-        """ This method makes the lapping event plot between FB and AC6 """
+    def plot_lap_event(self, tRange, acDtype='10Hz', lag=None, acData=None):
+        """ 
+        This method makes the lapping event plot between FB and AC6. 
+        If acData is given (e.g. prefetched by plot_lap_events), it is 
+        used instead of loading the AC6 data for tRange.
+        """
         if not hasattr(self, 'hr'):
             self._load_fb_data(tRange)
             print('Loading single day HiRes')
-        try:
-            self._load_ac_data(tRange, acDtype)
-        except AssertionError as err:
-            if ('None or > 1 AC6 files found in' in str(err) 
-                            or 'File is empty'  in str(err)):
-                return -1
-            else:
-                raise
+        if acData is not None:
+            self.acData = acData
+        else:
+            try:
+                self._load_ac_data(tRange, acDtype)
+            except AssertionError as err:
+                if self._ac_file_missing(err):
+                    return -1
+                else:
+                    raise
         
         # Only implement the lag for start of run, and implement 
         # the end time later.
@@ -62,7 +73,7 @@ class Lap():
             return -1
         if lag is not None:
             self.ac_time_lag = lag
-        in_track_lag = (self.fbBounds[0] - self.ac6Bounds[0]).total_seconds()
+        in_track_lag = (self.fbBounds[0] - self.ac6Bounds[0])/1E6
 
         fig, ax = plt.subplots(2, figsize=(8, 9))
         self._plot_fb(tRange, ax[0])
@@ -81,22 +92,32 @@ class Lap():
         # Set xlims for all subplots
         #for a in ax:
         #    a.set_xlim(*tRange)
-        ax[0].set_xlim(*self.fbBounds)
-        ax[1].set_xlim(*self.ac6Bounds)
+        ax[0].set_xlim(*np.array(self.fbBounds).view('datetime64[us]'))
+        ax[1].set_xlim(*np.array(self.ac6Bounds).view('datetime64[us]'))
         
         for a in ax: # Format time stamps for all subplots
             myFmt = matplotlib.dates.DateFormatter('%H:%M:%S')
             a.xaxis.set_major_formatter(myFmt)
         return 1
 
-    def plot_lap_events(self, saveDir=None, acDtype='10Hz'):
+    def plot_lap_events(self, saveDir=None, acDtype='10Hz', prefetch=2):
         """
         This method is similar to plot_lap_event, but it automatically
         sifts through any HiRes data avaliable between self.startDate 
         and self.endDate, and plots the AC6-FRIEBIRD data for those
         times, with no regard to their separation at that time. 
+
+        While one day's events are plotted, the AC6 data for the next 
+        prefetch (at least 1) days with HiRes data is loaded in a 
+        background thread.
         """
-        self._load_all_fb_data()
+        if prefetch < 1: # Check before the slow HiRes data loading.
+            raise ValueError('prefetch must be at least 1, got '
+                            'prefetch={}.'.format(prefetch))
+        # Reuse the HiRes data (and its McIlwainL/MLT) if it is already
+        # loaded from a previous call, e.g. with a different acDtype.
+        if not getattr(self, '_allFbLoaded', False):
+            self._load_all_fb_data()
 
         if saveDir is None:
             saveDir = '/home/mike/research/leo-lapping-events/plots/{}/{}/'.format(
@@ -106,30 +127,46 @@ class Lap():
             print('Made directory at', saveDir)
 
         # Find all of the start/end times.
-        dt = (self.hr['Time'][1:] - self.hr['Time'][:-1])
-        tJump = np.where(dt > timedelta(minutes=1))[0]
-        idt = sorted(np.concatenate((tJump, tJump+1, [0], [len(self.hr['Time'])-1] )))
+        dt = (self.hr['time'][1:] - self.hr['time'][:-1])
+        tJump = np.where(dt > 60*10**6)[0]
+        idt = sorted(np.concatenate((tJump, tJump+1, [0], [len(self.hr)-1] )))
+        hrTimes = from_epoch(self.hr['time'][idt])
+
+        events = [(i, [hrTimes[2*k], hrTimes[2*k+1]]) for (k, i) in 
+                    enumerate(idt[::2])]
+        # Group the HiRes times by day since AC6 data comes in daily files.
+        eventDays = [list(g) for (_, g) in itertools.groupby(events, 
+                    key=lambda e: e[1][0].date())]
+        loader = functools.partial(self._prefetch_ac_data, dType=acDtype)
 
         # Now loop over the HiRes times and call the plot_lap_event() function.
-        for (i, j) in zip(idt[::2], idt[1::2]):
-            self.fb_time_shift = self.hr['Count_Time_Correction'][i]
-            flag = self.plot_lap_event([self.hr['Time'][i], self.hr['Time'][j]], acDtype=acDtype)
-            if flag != 1:
-                continue
-            plt.tight_layout()
-            saveDate = self.hr['Time'][i].isoformat().replace(
+        with Prefetcher([e[0][1][0] for e in eventDays], loader, 
+                        depth=prefetch) as p:
+            for ((_, acData), dayEvents) in zip(p, eventDays):
+                if acData is None: # No AC6 data that day.
+                    continue
+                for (i, tRange) in dayEvents:
+                    self.fb_time_shift = self.hr['Count_Time_Correction'][i]
+                    flag = self.plot_lap_event(tRange, acDtype=acDtype, 
+                                                acData=acData)
+                    if flag != 1:
+                        continue
+                    plt.tight_layout()
+                    saveDate = tRange[0].isoformat().replace(
                                         ':', '').replace('-', '').split('.')[0]
-            saveName = '{}_FU{}_AC6{}_lap.png'.format(saveDate, self.fb_id, self.ac_id)
-            plt.savefig(os.path.join(saveDir, saveName))
+                    saveName = '{}_FU{}_AC6{}_lap.png'.format(
+                                        saveDate, self.fb_id, self.ac_id)
+                    plt.savefig(os.path.join(saveDir, saveName))
         return
 
     def _load_fb_data(self, tRange):
         """ This method loads in the FIREBIRD-II data """
         hrName = 'FU{}_Hires_{}_L2.txt'.format(self.fb_id, tRange[0].date())
-        self.hr = spacepy.datamodel.readJSONheadedASCII(
-                            os.path.join(self.fbDir, hrName))
-        self.hr['Time'] = spacepy.time.Ticktock(self.hr['Time']).UTC
+        self.hr = read_fb_data.read_hires(os.path.join(self.fbDir, hrName))
+        self.fb_energy = self.hr.attrs['Col_counts']
         self.fb_time_shift = np.mean(self.hr['Count_Time_Correction'])
+        # Use the HiRes file's McIlwainL and MLT.
+        self._magDone = np.ones(len(self.hr), dtype=bool)
         return
 
     def _load_all_fb_data(self):
@@ -138,39 +175,74 @@ class Lap():
         """
         # Load in the FIREBIRD HiRes data between specified time range, and find all HiRes times.
         days = [self.startDate + timedelta(days=i) for i in range((self.endDate-self.startDate).days)]
-        self.hr = {'Time':np.array([]), 'Count_Time_Correction':np.array([]), 
-                    'Col_counts':np.nan*np.ones((0, 6), dtype=int), 'Lat':np.array([]), 
-                    'Lon':np.array([]), 'Alt':np.array([]), 
-                    'McIlwainL':np.array([]), 'MLT':np.array([]), 
-                    'Loss_cone_type':np.array([])}
+        hr = []
         for day in days:
             hrName = 'FU{}_Hires_{}_L2.txt'.format(self.fb_id, day.date())
             try:
-                hrTemp = spacepy.datamodel.readJSONheadedASCII(
-                                    os.path.join(self.fbDir, hrName))
+                hr.append(read_fb_data.read_hires(os.path.join(self.fbDir, hrName)))
             except FileNotFoundError: # If no file found, move on.
                 continue
-
-            hrTemp['Time'] = spacepy.time.Ticktock(hrTemp['Time']).UTC
-
-            for key in filter(lambda x: x != 'Col_counts', self.hr):
-                self.hr[key] = np.append(self.hr[key], hrTemp[key])      
-            self.hr['Col_counts'] = np.concatenate(
-                                    (self.hr['Col_counts'], hrTemp['Col_counts']))
-                                    
-            self.fb_energy = hrTemp['Col_counts'].attrs['ELEMENT_LABELS']
-            
-        # Now run IRBEM.
-        self.hr['McIlwainL'], self.hr['MLT'] = self._calc_mag_pos(self.hr['Lat'],
-                             self.hr['Lon'], self.hr['Alt'], self.hr['Time'])
+        if len(hr) == 0:
+            raise FileNotFoundError('No HiRes files found between {} and {} '
+                            'in {}'.format(self.startDate, self.endDate, self.fbDir))
+        self.hr = Ephem.concatenate(hr)
+        self.fb_energy = self.hr.attrs['Col_counts']
+        # IRBEM is run lazily by _mag_window(), only for the HiRes times 
+        # that are looked at.
+        self._magDone = np.zeros(len(self.hr), dtype=bool)
+        self._allFbLoaded = True
         return
 
+    def _mag_window(self, tStart, tEnd):
+        """
+        This method returns a view of the HiRes data between tStart and 
+        tEnd, with McIlwainL and MLT calculated with the OPQ model. Only
+        the samples in the window that were not calculated before are 
+        run through IRBEM, and the results are saved in self.hr.
+        """
+        i0, i1 = self.hr.window_index(tStart, tEnd)
+        idx = i0 + np.where(~self._magDone[i0:i1])[0]
+        if len(idx):
+            L, MLT = self._calc_mag_pos(self.hr['Lat'][idx], 
+                                self.hr['Lon'][idx], self.hr['Alt'][idx], 
+                                from_epoch(self.hr['time'][idx]))
+            self.hr['McIlwainL'][idx] = L
+            self.hr['MLT'][idx] = MLT
+            self._magDone[idx] = True
+        return self.hr[i0:i1]
+
     def _load_ac_data(self, tRange, dType='10Hz'):
         """ This method loads in the AC-6 data """
-        self.acData = read_ac_data.read_ac_data_wrapper(self.ac_id,
-            tRange[0], dType=dType, plot=False)
+        self.acData = self._read_ac_data(tRange[0], dType)
         return
 
+    def _read_ac_data(self, day, dType='10Hz'):
+        """ This method reads one day of AC-6 data into an Ephem """
+        import read_ac_data
+        rawAc = read_ac_data.read_ac_data_wrapper(self.ac_id,
+            day, dType=dType, plot=False)
+        return Ephem(to_epoch(rawAc['dateTime']), 
+                    {key:np.asarray(rawAc[key], dtype=np.float64) for key in 
+                    ['dos1rate', 'dos2rate', 'dos3rate', 'Lm_OPQ', 'MLT_OPQ']})
+
+    def _prefetch_ac_data(self, day, dType='10Hz'):
+        """
+        This method is the background loader for plot_lap_events. It 
+        returns None if there is no AC-6 data that day.
+        """
+        try:
+            return self._read_ac_data(day, dType)
+        except AssertionError as err:
+            if self._ac_file_missing(err):
+                return None
+            else:
+                raise
+
+    def _ac_file_missing(self, err):
+        """ Checks if a read_ac_data error is due to a missing/empty file """
+        return ('None or > 1 AC6 files found in' in str(err) 
+                            or 'File is empty'  in str(err))
+
     def _load_sep(self, fPath):
         """
         This method loads in the separation data file and saves it so self.sep
@@ -179,35 +251,30 @@ class Lap():
             r = csv.reader(f)
             next(r) # Skip header
             rData = np.array(list(r))
-        self.sep = {}
-        self.sep['dateTime'] = np.array([dateutil.parser.parse(t) for t in rData[:, 0]])
-        self.sep['d_in_track'] = np.array([float(f) for f in rData[:, 1]])
-        self.sep['d_cross_track'] = np.array([float(f) for f in rData[:, 2]])
+        self.sep = Ephem(parse_times(rData[:, 0]), {
+                    'd_in_track':rData[:, 1].astype(np.float64),
+                    'd_cross_track':rData[:, 2].astype(np.float64)})
         return
 
     def _plot_fb(self, tRange, axCounts, axL=True):
         """ This method plots the FIREBIRD col counts data. """
-        normTind = np.where((self.hr['Time'] > tRange[0]) & 
-                            (self.hr['Time'] < tRange[1]))[0]
-        shiftInd = np.where(
-            (self.hr['Time'] > tRange[0]-timedelta(seconds=self.fb_time_shift)) & 
-            (self.hr['Time'] < tRange[1]-timedelta(seconds=self.fb_time_shift)))[0]
-        fbTimes = np.array([t+timedelta(seconds=self.fb_time_shift) 
-                            for t in self.hr['Time'][normTind]])
+        hr = self._mag_window(*tRange)
+        fbTimes = hr.datetime64() + np.timedelta64(
+                            int(1E6*self.fb_time_shift), 'us')
         for E in range(6):
-            axCounts.plot(fbTimes, self.hr['Col_counts'][normTind, E],
+            axCounts.plot(fbTimes, hr['Col_counts'][:, E],
                     label='{}'.format(self.fb_energy[E]))
         axCounts.set(ylabel='FU{} counts/bin'.format(self.fb_id), yscale='log')
         axCounts.legend()
         if axL:
             axL = axCounts.twinx()
-            axL.plot(self.hr['Time'], np.abs(self.hr['McIlwainL']), 'k')
-            axL.set_ylabel('McIlwain L (OPQ) (solid black)\n '
+            axL.plot(hr.datetime64(), np.abs(hr['McIlwainL']), 'k')
+            axL.set_ylabel('McIlwain L ({}) (solid black)\n '.format(self.magModel) +
                             'Loss Cone Type (dashed black) (0=open, 1=DLC/trapped, 2=BLC)')
             axL.set_ylim(0, 12)
             
             # Plot loss cone type
-            axL.plot(self.hr['Time'], self.hr['Loss_cone_type'], 'k--')
+            axL.plot(hr.datetime64(), hr['Loss_cone_type'], 'k--')
             
         return
 
@@ -219,9 +286,9 @@ class Lap():
         # Plot dosimiter counts
         for key in ['dos1rate', 'dos2rate', 'dos3rate']:
             validCounts = np.where((self.acData[key] != -1E31) & 
-                            (self.acData['dateTime'] > self.ac6Bounds[0]) & 
-                            (self.acData['dateTime'] < self.ac6Bounds[1]) )[0]
-            axCounts.plot(self.acData['dateTime'][validCounts], 
+                            (self.acData['time'] > self.ac6Bounds[0]) & 
+                            (self.acData['time'] < self.ac6Bounds[1]) )[0]
+            axCounts.plot(self.acData.datetime64()[validCounts], 
                         self.acData[key][validCounts],
                         label=key)
         axCounts.set_yscale('log')
@@ -231,7 +298,7 @@ class Lap():
         if axL:
             axL = axCounts.twinx()
             validL = np.where(self.acData['Lm_OPQ'] != -1E31)[0]
-            axL.plot(self.acData['dateTime'][validL], self.acData['Lm_OPQ'][validL], 'k')
+            axL.plot(self.acData.datetime64()[validL], self.acData['Lm_OPQ'][validL], 'k')
             axL.set_ylabel('McIlwain L (OPQ) (black curve)')
             axL.set_ylim(0, 12)
         return
@@ -243,9 +310,31 @@ class Lap():
         same L shells as FIREBIRD did (defined by tRange). I should soon
         implement the OPQ model for FIREBIRD for a direct model comparison. 
         """
+        tRange = to_epoch(tRange)
+        # Calculate the in-track lag as a first guess for the AC6 times.
+        idt = np.where((self.sep['time'] > tRange[0]) & 
+                        (self.sep['time'] < tRange[1]))[0]
+        if len(idt) == 0:
+            print('No separation datetimes found between {} and {}'.format(
+                                *from_epoch(tRange)))
+            return -1
+        tLag = 1E6*self.sep['d_in_track'][idt[0]]/7.5
+        # Get AC6 L shells around this time with a window.
+        id6t = np.where((self.acData['time'] > tRange[0] + tLag - 1E6*thresh) & 
+                        (self.acData['time'] < tRange[1] + tLag + 1E6*thresh))[0]
+        if len(id6t) == 0:
+            return -1
+        #print('len id6t=', len(id6t))
+        ac6L = self.acData['Lm_OPQ'][id6t]
+        ac6L[ac6L == -1E31] = np.nan # Replace IRBEM error values with nans.
+        if np.all(np.isnan(ac6L)):
+            return -1
+        # The FIREBIRD L shells are only calculated (with IRBEM) once the
+        # L independent checks above passed.
+        self._mag_window(*tRange)
         # Calculate FIREBIRD start/end L shells
-        fbIdt = np.where((self.hr['Time'] > tRange[0]) & 
-                        (self.hr['Time'] < tRange[1]))[0]
+        fbIdt = np.where((self.hr['time'] > tRange[0]) & 
+                        (self.hr['time'] < tRange[1]))[0]
         for i in fbIdt:
             if np.abs(self.hr['McIlwainL'][i]) != 1E31:
                 fbStartL = np.abs(self.hr['McIlwainL'][i])
@@ -257,27 +346,9 @@ class Lap():
                 fbEndI = i
                 break
         try: # If there are no valid L shells (over the polar cap, gracefully exit)
-            self.fbBounds = [self.hr['Time'][fbStartI], self.hr['Time'][fbEndI]]
+            self.fbBounds = [self.hr['time'][fbStartI], self.hr['time'][fbEndI]]
         except UnboundLocalError:
             return -1
-                
-        # Calculate the in-track lag as a first guess for the AC6 times.
-        idt = np.where((self.sep['dateTime'] > tRange[0]) & 
-                        (self.sep['dateTime'] < tRange[1]))[0]
-        if len(idt) == 0:
-            print('No separation datetimes found between {} and {}'.format(*tRange))
-            return -1
-        tLag = self.sep['d_in_track'][idt[0]]/7.5
-        # Get AC6 L shells around this time with a window.
-        id6t = np.where((self.acData['dateTime'] > tRange[0] + timedelta(seconds=tLag) - 
-                        timedelta(seconds=thresh)) & 
-                        (self.acData['dateTime'] < tRange[1] + timedelta(seconds=tLag) +
-                        timedelta(seconds=thresh)))[0]
-        if len(id6t) == 0:
-            return -1
-        #print('len id6t=', len(id6t))
-        ac6L = self.acData['Lm_OPQ'][id6t]
-        ac6L[ac6L == -1E31] = np.nan # Replace IRBEM error values with nans.
         # Calculate where AC6 L crosses FIREBIRD's L shells.
         try:
             acStartL = np.nanargmin(np.abs(ac6L - fbStartL))
@@ -288,20 +359,20 @@ class Lap():
         if acStartL == acEndL:
             return -1
         if verbose:
-            print('For time period:', tRange)
+            print('For time period:', from_epoch(tRange))
             print('FIREBIRD start L bounds', fbStartL, fbEndL)
             print('AC6 L bounds', self.acData['Lm_OPQ'][id6t[0] + acStartL], 
                                 self.acData['Lm_OPQ'][id6t[0] + acEndL])
         
-        self.ac6Bounds = [self.acData['dateTime'][id6t[0] + acStartL], 
-                          self.acData['dateTime'][id6t[0] + acEndL]]
+        self.ac6Bounds = [self.acData['time'][id6t[0] + acStartL], 
+                          self.acData['time'][id6t[0] + acEndL]]
         
         # If the difference in the bounds is > 1 (no AC6 data to that high of L 
         # shell, then recalculate the FIREBIRD bounds
         if np.abs(self.acData['Lm_OPQ'][id6t[0]+acStartL] - fbStartL) > 0.5:
             fbStartI = np.nanargmin(np.abs(np.abs(self.hr['McIlwainL'][fbIdt]) - 
                                 self.acData['Lm_OPQ'][id6t[0]+acStartL]))
-            self.fbBounds[0] = self.hr['Time'][fbStartI+fbIdt[0]] 
+            self.fbBounds[0] = self.hr['time'][fbStartI+fbIdt[0]] 
             if verbose:
                 print('New FIREBIRD start L', 
                         self.hr['McIlwainL'][fbStartI+fbIdt[0]] )
@@ -309,7 +380,7 @@ class Lap():
         if np.abs(self.acData['Lm_OPQ'][id6t[0]+acEndL] - fbEndL) > 0.5:
             fbEndI = np.nanargmin(np.abs(np.abs(self.hr['McIlwainL'][fbIdt]) - 
                                 self.acData['Lm_OPQ'][id6t[0]+acEndL]))
-            self.fbBounds[1] = self.hr['Time'][fbEndI+fbIdt[0]] 
+            self.fbBounds[1] = self.hr['time'][fbEndI+fbIdt[0]] 
             if verbose:
                 print('New FIREBIRD end L', 
                 self.hr['McIlwainL'][fbEndI+fbIdt[0]] )  
@@ -317,27 +388,22 @@ class Lap():
         
     def _calc_mag_pos(self, lat, lon, alt, time):
         """
-        This method calculates L and MLT using the Olson and Pfitzer Quiet model.
+        This method calculates L and MLT using the Olson and Pfitzer Quiet model
+        (or self.magModel).
         """
-        m = IRBEM.MagFields(kext='OPQ77')
-        L = np.nan*np.ones(len(lat))
-        MLT = np.nan*np.ones(len(lat))
-        
-        for i, (T, LAT, LON, ALT) in enumerate(zip(time, lat, lon, alt)):
-            X = {'dateTime':T, 'x1':ALT, 'x2':LAT, 'x3':LON}
-            m.make_lstar(X, None)
-            L[i] = m.make_lstar_output['Lm'][0]
-            MLT[i] = m.make_lstar_output['MLT'][0]
-        return L, MLT
+        import make_magephem
+        X = {'dateTime':time, 'x1':alt, 'x2':lat, 'x3':lon}
+        return make_magephem.calc_lm_mlt(self.magModel, None, X)
         
     def _dMLT(self):
         """
         This method calculates change in MLT during the interval plotted.
         """
-        fbInd = np.where((self.hr['Time'] > self.fbBounds[0]) &
-                         (self.hr['Time'] < self.fbBounds[1]))[0]
-        acInd = np.where((self.acData['dateTime'] > self.ac6Bounds[0]) &
-                         (self.acData['dateTime'] < self.ac6Bounds[1]))[0] 
+        self._mag_window(*self.fbBounds)
+        fbInd = np.where((self.hr['time'] > self.fbBounds[0]) &
+                         (self.hr['time'] < self.fbBounds[1]))[0]
+        acInd = np.where((self.acData['time'] > self.ac6Bounds[0]) &
+                         (self.acData['time'] < self.ac6Bounds[1]))[0] 
         fbMLT = np.mean(self.hr['MLT'][fbInd])
         acMLT = np.mean(self.acData['MLT_OPQ'][acInd])
         return np.abs(fbMLT-acMLT)           
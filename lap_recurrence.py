@@ -0,0 +1,133 @@
+# This script fits the recurrence of lapping events and predicts when
+# the next ones will happen.
+import numpy as np
+
+class LapRecurrence():
+    def __init__(self, startTimes, endTimes=None, periodRange=(28000, 34000)):
+        """
+        This class fits the lapping event recurrence period and phase
+        drift from a list of lapping event start times (e.g.
+        LapTimes.startTime), and predicts the time windows of future
+        lapping events. periodRange is the range of plausible recurrence
+        periods in seconds, used to reject closely spaced (or missing)
+        events when making the first guess of the period.
+        """
+        self.startTimes = np.asarray(startTimes, dtype='datetime64[us]')
+        if endTimes is None:
+            self.endTimes = self.startTimes
+        else:
+            self.endTimes = np.asarray(endTimes, dtype='datetime64[us]')
+        self.periodRange = periodRange
+        if len(self.startTimes) < 2:
+            raise ValueError('At least two lapping events are needed to fit '
+                            'the recurrence period.')
+        self.t0 = self.startTimes[0]
+        return
+
+    def fit(self):
+        """
+        This method fits the lapping event start times with
+        t_k = t0 + period*k + drift*k^2, where k is the lap number.
+        The drift term captures the slow change in the recurrence
+        period (e.g. due to differential drag). Closely spaced events 
+        get the same lap number, and only the first event of each lap is
+        fit. The standard deviation of the fit residuals is saved to 
+        self.sigma (in seconds).
+        """
+        t = self._seconds(self.startTimes)
+        dt = np.diff(t)
+        validDt = dt[(dt > self.periodRange[0]) & (dt < self.periodRange[1])]
+        if len(validDt) == 0:
+            raise ValueError('No lapping event spacings found in the '
+                            'periodRange={} s.'.format(self.periodRange))
+        # Number the laps from the consecutive event spacings (long gaps
+        # from missed events skip lap numbers) with the median period, and 
+        # then renumber them once with the local period of the first fit.
+        periodGuess = np.median(validDt)*np.ones(len(dt))
+        for _ in range(2):
+            self.lapNum = np.concatenate(([0], np.cumsum(np.round(dt/periodGuess))))
+            _, iFirst = np.unique(self.lapNum, return_index=True)
+            # Only fit the phase drift if there are enough distinct laps.
+            deg = 2 if len(iFirst) > 3 else 1
+            coeffs = np.polyfit(self.lapNum[iFirst], t[iFirst], deg)
+            if deg == 1:
+                coeffs = np.insert(coeffs, 0, 0)
+            # The expected spacing of one lap after each event's lap.
+            periodGuess = coeffs[1] + coeffs[0]*(2*self.lapNum[:-1] + 1)
+        self.drift, self.period, self.phase = coeffs
+        self.sigma = np.std(t[iFirst] - np.polyval(coeffs, self.lapNum[iFirst]))
+        self.duration = np.median(self._seconds(self.endTimes) - t)
+        return self.period, self.drift
+
+    def predict(self, startDate, endDate, nSigma=3, margin=0):
+        """
+        This method predicts the lapping event windows between startDate
+        and endDate. Each window is centered on the predicted lap time,
+        padded by nSigma times the fit residual standard deviation and
+        an additional margin (in seconds) on both sides. Returns the
+        window start and end times as datetime arrays.
+        """
+        if not hasattr(self, 'period'):
+            self.fit()
+        kRange = self._lap_number(np.asarray([startDate, endDate],
+                                            dtype='datetime64[us]'))
+        k = np.arange(np.floor(kRange[0])-1, np.ceil(kRange[1])+2)
+        center = np.polyval([self.drift, self.period, self.phase], k)
+        pad = nSigma*self.sigma + margin
+        wStart = self._datetimes(center - pad)
+        wEnd = self._datetimes(center + self.duration + pad)
+        # Only keep the windows that overlap with the requested time range.
+        idx = np.where((wEnd > np.datetime64(startDate, 'us')) &
+                       (wStart < np.datetime64(endDate, 'us')))[0]
+        return wStart[idx].astype(object), wEnd[idx].astype(object)
+
+    def _lap_number(self, times):
+        """
+        This method inverts the fit to find the (fractional) lap number
+        at the given times.
+        """
+        t = self._seconds(times)
+        if self.drift == 0:
+            return (t - self.phase)/self.period
+        # Take the root closest to the linear solution.
+        disc = np.sqrt(self.period**2 - 4*self.drift*(self.phase - t))
+        return (-self.period + np.sign(self.period)*disc)/(2*self.drift)
+
+    def _seconds(self, times):
+        """ Converts datetime64 times to seconds since the first event. """
+        return (times - self.t0)/np.timedelta64(1, 's')
+
+    def _datetimes(self, seconds):
+        """ Converts seconds since the first event to datetime64 times. """
+        return self.t0 + (1E6*seconds).astype('timedelta64[us]')
+
+def in_windows(times, windows):
+    """
+    This function returns a boolean mask of the times that are inside
+    any of the windows, given as a (start times, end times) tuple such
+    as the output of LapRecurrence.predict(). The windows must be sorted
+    and not overlap.
+    """
+    times = np.asarray(times, dtype='datetime64[us]')
+    wStart = np.asarray(windows[0], dtype='datetime64[us]')
+    wEnd = np.asarray(windows[1], dtype='datetime64[us]')
+    # Index of the last window that started before each time.
+    i = np.searchsorted(wStart, times, side='right') - 1
+    inside = i >= 0
+    inside[inside] = times[inside] <= wEnd[i[inside]]
+    return inside
+
+if __name__ == '__main__':
+    from datetime import datetime
+    import calc_lap_times
+    sc = ['FU3', 'REACH']
+    L = calc_lap_times.LapTimes(*sc, './data/dist/'
+                '20190125_{}_REACH_dist.csv'.format(sc[0]))
+    L.calcLapTimes(thresh=1000)
+    r = LapRecurrence(L.startTime, L.endTime)
+    r.fit()
+    print('Recurrence period = {} s, drift = {} s/lap^2, sigma = {} s'.format(
+            round(r.period, 1), round(r.drift, 3), round(r.sigma, 1)))
+    windows = r.predict(datetime(2019, 2, 1), datetime(2019, 2, 8), margin=600)
+    for w in zip(*windows):
+        print(*w)
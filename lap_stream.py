@@ -0,0 +1,109 @@
+# This script finds lapping events in a stream of separation samples, e.g.
+# from a freshly propagated ephemeris, without loading the whole file.
+from collections import namedtuple
+import numpy as np
+
+from ephemeris import to_epoch, from_epoch
+import calc_lap_times
+
+# The same fields, in the same order, as LapTimes.saveData() writes.
+LapEvent = namedtuple('LapEvent', ['startTime', 'endTime', 'duration',
+                                    'dmin', 'scALmin', 'scBLmin'])
+
+class LapStream():
+    def __init__(self, sc_a, sc_b, thresh=500):
+        """
+        This class detects the lapping events (separation below thresh km)
+        in separation samples that arrive in time order, one batch at a
+        time. Only the currently open event is kept in memory, and the
+        events are returned as soon as the separation goes back above
+        thresh. A batch is a mapping (e.g. an Ephem) with the 'time'
+        (datetimes or epoch times) and the separation file columns
+        'dist_in_track [km]', 'dist_cross_track [km]', 'L_<sc_a>', and
+        'L_<sc_b>'.
+        """
+        self.sc_a = sc_a
+        self.sc_b = sc_b
+        self.thresh = thresh
+        self.header = calc_lap_times.lap_header(sc_a, sc_b)
+        self._open = None # [start, end, dmin, scALmin, scBLmin] of the open event.
+        return
+
+    def update(self, batch):
+        """
+        This method processes a batch of separation samples and returns
+        a list of the LapEvents that finished.
+        """
+        t = to_epoch(batch['time'])
+        d = np.sqrt(np.asarray(batch['dist_in_track [km]'])**2 +
+                    np.asarray(batch['dist_cross_track [km]'])**2)
+        La = np.asarray(batch['L_{}'.format(self.sc_a)])
+        Lb = np.asarray(batch['L_{}'.format(self.sc_b)])
+        if len(t) == 0:
+            return []
+
+        # Find the runs of samples below the threshold in this batch.
+        below = np.concatenate(([False], d < self.thresh, [False]))
+        startInd = np.where(~below[:-1] & below[1:])[0]
+        endInd = np.where(below[:-1] & ~below[1:])[0] - 1
+
+        events = []
+        if self._open is not None and not below[1]:
+            # The open event ended with the last batch.
+            events.append(self._finish())
+        for (sI, eI) in zip(startInd, endInd):
+            iMin = sI + np.argmin(d[sI:eI+1])
+            run = [t[sI], t[eI], d[iMin], La[iMin], Lb[iMin]]
+            if sI == 0 and self._open is not None:
+                # The run continues the open event.
+                self._open[1] = t[eI]
+                if d[iMin] < self._open[2]:
+                    self._open[2:] = run[2:]
+            else:
+                self._open = run
+            if eI < len(t)-1:
+                events.append(self._finish())
+        return events
+
+    def push(self, time, dInTrack, dCrossTrack, La, Lb):
+        """ This method processes a single separation sample. """
+        return self.update({'time':[time], 'dist_in_track [km]':[dInTrack],
+                            'dist_cross_track [km]':[dCrossTrack],
+                            'L_{}'.format(self.sc_a):[La],
+                            'L_{}'.format(self.sc_b):[Lb]})
+
+    def close(self):
+        """
+        This method ends the stream and returns the open event, if any,
+        as a list.
+        """
+        if self._open is None:
+            return []
+        return [self._finish()]
+
+    def detect(self, batches):
+        """
+        This generator yields the LapEvents from an iterable of batches,
+        including the event that is open at the end of the stream.
+        """
+        for batch in batches:
+            yield from self.update(batch)
+        yield from self.close()
+
+    async def adetect(self, batches):
+        """ This is the async iterator version of detect(). """
+        async for batch in batches:
+            for event in self.update(batch):
+                yield event
+        for event in self.close():
+            yield event
+
+    def _finish(self):
+        """ This method turns the open event into a LapEvent. """
+        start, end, dmin, scALmin, scBLmin = self._open
+        self._open = None
+        # Same as LapTimes, one sample events last a minute.
+        if end == start:
+            end += 60*10**6
+        return LapEvent(from_epoch(start), from_epoch(end),
+                        (end - start)/(60*10**6), dmin, scALmin, scBLmin)
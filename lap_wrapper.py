@@ -1,19 +1,39 @@
-# This is a wrapper to process the lap times completely. 
+# This is a wrapper to process the lap times completely.
+# Each step is a function so that batch workers (e.g. one process per
+# spacecraft pair) can import and run only the step they need. The
+# magnetic ephemeris step is the only one that needs pandas and IRBEM,
+# so make_magephem is only imported there.
 from datetime import datetime
 import os
+import numpy as np
 
 import calc_dist
 import calc_lap_times
-import make_magephem
+import lap_recurrence
 
 START_DATE = datetime(2018, 12, 10)
 END_DATE = datetime(2019, 1, 30)
 
 sc_a_arr = ['FU3', 'FU4']
 sc_b_arr = ['ELFIN_A']
+THRESHOLDS = [500, 1000] # km
+# If True, find the lap events with the fast dipole L and MLT first, and
+# then only run IRBEM for the times inside those events.
+SCREEN = False
+# Only the screened events with both dipole L shells in this range get the
+# full IRBEM run. It is wider than the L range of interest since the 
+# dipole L is approximate.
+SCREEN_L = (3, 10)
 
-print('Making magnetic ephemeris')
-for sc_id in sc_a_arr + sc_b_arr:
+def run_magephem(sc_id, screen=False, windows=None):
+    """ 
+    Makes the magnetic ephemeris for one spacecraft. If screen is True,
+    only the dipole L and MLT is calculated. If windows, a list of 
+    (start times, end times) lap event windows, is given, IRBEM is only 
+    run inside the windows (the IRBEM L and MLT are nan elsewhere) and 
+    the dipole L and MLT are saved in extra columns.
+    """
+    import make_magephem
     ephemDir = './data/ephem'
     ephemName = '{}_{}_{}_LLA_ephemeris.csv'.format(
                    sc_id,
@@ -21,32 +41,96 @@ for sc_id in sc_a_arr + sc_b_arr:
                    END_DATE.date())
     magephemName = ephemName.split('_')
     magephemName[-1] = 'magephem.csv'
-    magephemName.pop(-2) 
+    magephemName.pop(-2)
     magephemName = '_'.join(magephemName)
     a = make_magephem.AppendMagEphem(os.path.join(ephemDir, ephemName))
-    a.calc_magephem(maginput={'Kp':20})
+    mask = None
+    if screen or windows is not None:
+        a.screen_magephem()
+    if windows is not None:
+        mask = np.any([lap_recurrence.in_windows(a.eph['dateTime'].values, w) 
+                        for w in windows], axis=0)
+    if not screen:
+        a.calc_magephem(maginput={'Kp':20}, mask=mask)
     a.save_magephem(os.path.join('./data/magephem/', magephemName))
-    
-print('Calculating separations')
-for a_id in sc_a_arr:
-    for b_id in sc_b_arr:
-        pathA = ('./data/magephem/{}_{}_{}_magephem.csv'.format(
-                a_id, START_DATE.date(), END_DATE.date()))
-        pathB = ('./data/magephem/{}_{}_{}_magephem.csv'.format(
-                b_id, START_DATE.date(), END_DATE.date()))
-        saveDir = ('./data/dist/{}_{}_{}_{}_dist_v2.csv'.format(
-                    START_DATE.date(), END_DATE.date(), a_id, b_id))
-        c = calc_dist.CalcDist(a_id, b_id, START_DATE, END_DATE, pathA, pathB)
-        c.calc_dist()
-        c.save_file(saveDir)
-        #c.plot_dist()
-        #plt.show()
-        
-print('Calculating lap times')
-for a_id in sc_a_arr:
-    for b_id in sc_b_arr:
-        L = calc_lap_times.LapTimes(a_id, b_id, '/home/mike/research/leo-lapping-events/data/dist/'
-                    '{}_{}_{}_{}_dist_v2.csv'.format(START_DATE.date(), END_DATE.date(), a_id, b_id))
-        L.calcLapTimes()
-        L.saveData('./data/lap_times/{}_{}_{}_{}_lap_times.csv'.format(
-                    START_DATE, END_DATE, a_id, b_id))
+    return
+
+def run_separation(a_id, b_id):
+    """ Calculates the separation between one pair of spacecraft. """
+    pathA = ('./data/magephem/{}_{}_{}_magephem.csv'.format(
+            a_id, START_DATE.date(), END_DATE.date()))
+    pathB = ('./data/magephem/{}_{}_{}_magephem.csv'.format(
+            b_id, START_DATE.date(), END_DATE.date()))
+    saveDir = ('./data/dist/{}_{}_{}_{}_dist_v2.csv'.format(
+                START_DATE.date(), END_DATE.date(), a_id, b_id))
+    c = calc_dist.CalcDist(a_id, b_id, START_DATE, END_DATE, pathA, pathB)
+    c.calc_dist()
+    c.save_file(saveDir)
+    #c.plot_dist()
+    #plt.show()
+    return
+
+def run_lap_times(a_id, b_id, windows=None):
+    """ 
+    Calculates the lap times between one pair of spacecraft. If windows,
+    the pair's (start times, end times) IRBEM windows, is given, only the
+    events inside them are kept. The events that the dipole L screening
+    rejected have no IRBEM L shells, so they are dropped.
+    """
+    L = calc_lap_times.LapTimes(a_id, b_id, '/home/mike/research/leo-lapping-events/data/dist/'
+                '{}_{}_{}_{}_dist_v2.csv'.format(START_DATE.date(), END_DATE.date(), a_id, b_id),
+                windows=windows)
+    for thresh in THRESHOLDS:
+        L.calcLapTimes(thresh=thresh)
+        L.saveData('./data/lap_times/{}_{}_{}_{}_lap_times_{}km_thresh.csv'.format(
+                    START_DATE, END_DATE, a_id, b_id, thresh))
+    return
+
+def lap_windows(a_id, b_id, thresh=max(THRESHOLDS), minL=None, maxL=None):
+    """ 
+    Returns the (start times, end times) of one pair's lap events. If 
+    minL and/or maxL are given, only the events where both spacecraft's 
+    L shells (at the minimum separation) are inside that range are kept.
+    """
+    L = calc_lap_times.LapTimes(a_id, b_id, './data/dist/{}_{}_{}_{}_dist_v2.csv'.format(
+                START_DATE.date(), END_DATE.date(), a_id, b_id))
+    L.calcLapTimes(thresh=thresh)
+    keep = np.ones(len(L.startTime), dtype=bool)
+    for scL in [L.scALmin, L.scBLmin]:
+        if minL is not None:
+            keep &= scL > minL
+        if maxL is not None:
+            keep &= scL < maxL
+    return L.startTime[keep], L.endTime[keep]
+
+if __name__ == '__main__':
+    print('Making magnetic ephemeris')
+    for sc_id in sc_a_arr + sc_b_arr:
+        run_magephem(sc_id, screen=SCREEN)
+
+    print('Calculating separations')
+    for a_id in sc_a_arr:
+        for b_id in sc_b_arr:
+            run_separation(a_id, b_id)
+
+    if SCREEN:
+        print('Running IRBEM inside the screened lap events')
+        windows = {sc_id:[] for sc_id in sc_a_arr + sc_b_arr}
+        pairWindows = {}
+        for a_id in sc_a_arr:
+            for b_id in sc_b_arr:
+                w = lap_windows(a_id, b_id, minL=SCREEN_L[0], maxL=SCREEN_L[1])
+                pairWindows[(a_id, b_id)] = w
+                windows[a_id].append(w)
+                windows[b_id].append(w)
+        for sc_id in sc_a_arr + sc_b_arr:
+            run_magephem(sc_id, windows=windows[sc_id])
+        for a_id in sc_a_arr:
+            for b_id in sc_b_arr:
+                run_separation(a_id, b_id)
+
+    print('Calculating lap times')
+    for a_id in sc_a_arr:
+        for b_id in sc_b_arr:
+            run_lap_times(a_id, b_id, windows=pairWindows[(a_id, b_id)] 
+                            if SCREEN else None)
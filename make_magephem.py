@@ -3,60 +3,27 @@ import csv
 import numpy as np
 import os
 import dateutil.parser
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 
 import IRBEM
 
-class AppendMagEphem(IRBEM.MagFields):
-    def __init__(self, ephemPath, kext='T89'):
-        IRBEM.MagFields.__init__(self, kext=kext)
-        self.extModel = kext
-        self.ephemPath = ephemPath
-        # if 'reach' not in ephemPath:
-        #     self._load_ephem(ephemPath)
-        # else:
-        #     self._load_reach(ephemPath)
-        self.load_ephem(ephemPath)
-        return
-
-    def calc_magephem(self, maginput=None):
-        """
-        This method loops over the epehem times and calculates L and MLT
-        """
+import dipole
+from ephemeris import to_epoch, from_epoch
 
-        self.L = np.nan*np.ones(len(self.eph['Alt']))
-        self.MLT = np.nan*np.ones(len(self.eph['Alt']))
-
-        z = zip(self.eph['dateTime'].dt.to_pydatetime(),
-                self.eph['Alt'], self.eph['Lat'], 
-                self.eph['Lon'])
-        
-        for i, (time, alt, lat, lon) in enumerate(z):
-            X = {'dateTime':time, 'x1':alt, 'x2':lat, 'x3':lon}
-            self.make_lstar(X, maginput)
-
-            self.L[i] = self.make_lstar_output['Lm'][0]
-            self.MLT[i] = self.make_lstar_output['MLT'][0]
-        return
-
-    def save_magephem(self, path):
-        """ 
-        This method appends the L and MLT to the ephemeris and saves it to path.
-        """
-        z = zip(self.eph['dateTime'], self.eph['Lat'], self.eph['Lon'],
-                self.eph['Alt'], self.L, self.MLT)
-        with open(path, 'w', newline='') as f:
-            w = csv.writer(f)
-            keys = ['dateTime','Lat','Lon','Alt',
-                     'Lm_{}'.format(self.extModel), 
-                     'MLT_{}'.format(self.extModel)]
-            w.writerow(keys)
-
-            for line in z:
-                w.writerow([*line])
-        return
+IRBEM_CHUNK = 50000 # Points per make_lstar call, below IRBEM's NTIME_MAX.
+# The analytic dipole models (and if they are eccentric) that can be used 
+# in place of the IRBEM kext models.
+DIPOLE_MODELS = {'DIPOLE':False, 'ECC_DIPOLE':True}
 
+class LoadEphem():
+    """
+    This mixin loads the ephemeris file (with pandas) into self.eph, with
+    its times and positions in the dateTime, Alt, Lat, and Lon columns.
+    It is shared by AppendMagEphem and BatchMagEphem.
+    """
     def load_ephem(self, path):
         """
         This method reads in the ephemeris file.
@@ -116,6 +83,215 @@ class AppendMagEphem(IRBEM.MagFields):
         return data
 
 
+class AppendMagEphem(IRBEM.MagFields, LoadEphem):
+    def __init__(self, ephemPath, kext='T89'):
+        IRBEM.MagFields.__init__(self, kext=kext)
+        self.extModel = kext
+        self.ephemPath = ephemPath
+        # if 'reach' not in ephemPath:
+        #     self._load_ephem(ephemPath)
+        # else:
+        #     self._load_reach(ephemPath)
+        self.load_ephem(ephemPath)
+        return
+
+    def calc_magephem(self, maginput=None, mask=None):
+        """
+        This method calculates L and MLT for the epehem times, in chunks
+        with calc_lm_mlt(). If mask is given, only the times where it is 
+        True are calculated, and the other times are nan.
+        """
+        self.L = np.nan*np.ones(len(self.eph['Alt']))
+        self.MLT = np.nan*np.ones(len(self.eph['Alt']))
+        if mask is None:
+            mask = np.ones(len(self.eph['Alt']), dtype=bool)
+
+        X = {'dateTime':self.eph['dateTime'].dt.to_pydatetime()[mask],
+            'x1':self.eph['Alt'].values[mask], 'x2':self.eph['Lat'].values[mask],
+            'x3':self.eph['Lon'].values[mask]}
+        self.L[mask], self.MLT[mask] = calc_lm_mlt(self.extModel, 
+                                            mask_maginput(maginput, mask), X)
+        return
+
+    def screen_magephem(self, eccentric=True):
+        """
+        This method quickly calculates the (eccentric) dipole L and MLT
+        for all of the ephem times. It is meant to find the lapping events
+        first, and then run calc_magephem() with a mask for only the 
+        times inside those events. The dipole values are saved in their
+        own columns, after the calc_magephem() ones if those were made.
+        """
+        self.dipoleModel = 'ECC_DIPOLE' if eccentric else 'DIPOLE'
+        self.dipoleL, self.dipoleMLT = dipole.calc_lm_mlt(
+                    self.eph['dateTime'].values, self.eph['Alt'].values, 
+                    self.eph['Lat'].values, self.eph['Lon'].values, 
+                    eccentric=eccentric)
+        return
+
+    def save_magephem(self, path):
+        """ 
+        This method appends the L and MLT to the ephemeris and saves it to path.
+        The model (calc_magephem) columns come first, followed by the 
+        dipole (screen_magephem) columns.
+        """
+        cols = []
+        if hasattr(self, 'L'):
+            cols.extend([('Lm_{}'.format(self.extModel), self.L), 
+                        ('MLT_{}'.format(self.extModel), self.MLT)])
+        if hasattr(self, 'dipoleL'):
+            cols.extend([('Lm_{}'.format(self.dipoleModel), self.dipoleL), 
+                        ('MLT_{}'.format(self.dipoleModel), self.dipoleMLT)])
+        if len(cols) == 0:
+            raise ValueError('No L and MLT to save. Run calc_magephem() or '
+                            'screen_magephem() first.')
+        keys, vals = zip(*cols)
+        z = zip(self.eph['dateTime'], self.eph['Lat'], self.eph['Lon'],
+                self.eph['Alt'], *vals)
+        with open(path, 'w', newline='') as f:
+            w = csv.writer(f)
+            keys = ['dateTime','Lat','Lon','Alt', *keys]
+            w.writerow(keys)
+
+            for line in z:
+                w.writerow([*line])
+        return
+
+
+class BatchMagEphem(LoadEphem):
+    def __init__(self, ephemPath, configs):
+        """
+        This class calculates the magnetic ephemeris for several magnetic
+        field model configurations in one pass. configs is a list of 
+        (kext, maginput) tuples, e.g. [('OPQ77', None), ('T89', {'Kp':20}), 
+        ('T89', {'Kp':40}), ('ECC_DIPOLE', None)]. Each configuration 
+        makes its own IRBEM model (or dipole) in calc_lm_mlt().
+        """
+        self.configs = configs
+        self.labels = config_labels(configs)
+        self.ephemPath = ephemPath
+        self.load_ephem(ephemPath)
+        return
+
+    def calc_magephem(self, mask=None, nProc=None):
+        """
+        This method calculates L and MLT for all of the configurations,
+        with up to nProc configurations running in parallel processes
+        (IRBEM is not thread safe). If mask is given, only the times where
+        it is True are calculated, and the other times are nan. The 
+        results are saved in the self.L and self.MLT dictionaries, keyed 
+        by the configuration labels.
+
+        The ephemeris is loaded, masked, and converted to int64 epoch 
+        times and float position arrays once, and those compact arrays
+        are sent to the workers. Each worker still converts the times to
+        datetimes, and IRBEM converts those to its own time format, so that
+        part is repeated for every configuration.
+        """
+        if mask is None:
+            mask = np.ones(len(self.eph['Alt']), dtype=bool)
+        t = to_epoch(self.eph['dateTime'].values[mask])
+        pos = [self.eph[key].values[mask].astype(float) for key in 
+                ['Alt', 'Lat', 'Lon']]
+        kexts, maginputs = zip(*self.configs)
+        maginputs = [mask_maginput(maginput, mask) for maginput in maginputs]
+
+        with ProcessPoolExecutor(max_workers=nProc) as pool:
+            results = list(pool.map(_calc_lm_mlt_epoch, kexts, maginputs, 
+                        itertools.repeat(t), *[itertools.repeat(x) for x in pos]))
+        self.L = {}
+        self.MLT = {}
+        for label, (L, MLT) in zip(self.labels, results):
+            self.L[label] = np.nan*np.ones(len(mask))
+            self.MLT[label] = np.nan*np.ones(len(mask))
+            self.L[label][mask] = L
+            self.MLT[label][mask] = MLT
+        return
+
+    def save_magephem(self, path):
+        """ 
+        This method appends the L and MLT of every configuration to the 
+        ephemeris and saves it to path.
+        """
+        z = zip(self.eph['dateTime'], self.eph['Lat'], self.eph['Lon'],
+                self.eph['Alt'], *[self.L[label] for label in self.labels], 
+                *[self.MLT[label] for label in self.labels])
+        with open(path, 'w', newline='') as f:
+            w = csv.writer(f)
+            keys = ['dateTime','Lat','Lon','Alt',
+                    *['Lm_{}'.format(label) for label in self.labels],
+                    *['MLT_{}'.format(label) for label in self.labels]]
+            w.writerow(keys)
+
+            for line in z:
+                w.writerow([*line])
+        return
+
+def calc_lm_mlt(kext, maginput, X):
+    """
+    This function calculates L and MLT with the kext model for arrays of 
+    positions X (same keys as for make_lstar). Scalar maginput values are
+    applied to every point. kext can also be one of the DIPOLE_MODELS, 
+    which ignore maginput.
+    """
+    if kext in DIPOLE_MODELS:
+        return dipole.calc_lm_mlt(X['dateTime'], X['x1'], X['x2'], X['x3'],
+                                eccentric=DIPOLE_MODELS[kext])
+    m = IRBEM.MagFields(kext=kext)
+    n = len(X['x1'])
+    L = np.nan*np.ones(n)
+    MLT = np.nan*np.ones(n)
+
+    for i in range(0, n, IRBEM_CHUNK):
+        Xi = {key:X[key][i:i+IRBEM_CHUNK] for key in X}
+        if maginput is None:
+            maginputi = None
+        else:
+            maginputi = {key:(np.broadcast_to(val, len(Xi['x1'])) 
+                            if np.ndim(val) == 0 else val[i:i+IRBEM_CHUNK]) 
+                        for (key, val) in maginput.items()}
+        m.make_lstar(Xi, maginputi)
+        L[i:i+IRBEM_CHUNK] = m.make_lstar_output['Lm']
+        MLT[i:i+IRBEM_CHUNK] = m.make_lstar_output['MLT']
+    return L, MLT
+
+def _calc_lm_mlt_epoch(kext, maginput, t, alt, lat, lon):
+    """
+    This function is the BatchMagEphem worker. It converts the int64 
+    epoch times to datetimes in the worker process and calls calc_lm_mlt().
+    """
+    X = {'dateTime':from_epoch(t), 'x1':alt, 'x2':lat, 'x3':lon}
+    return calc_lm_mlt(kext, maginput, X)
+
+def mask_maginput(maginput, mask):
+    """
+    This function applies the mask to the maginput time series, and 
+    leaves the scalar values as they are.
+    """
+    if maginput is None:
+        return None
+    return {key:(val if np.ndim(val) == 0 else np.asarray(val)[mask])
+            for (key, val) in maginput.items()}
+
+def config_labels(configs):
+    """
+    This function makes the column labels for the (kext, maginput) 
+    configurations. The label is the model name, with the maginput
+    values appended (e.g. T89_Kp20) if a model is used more than once.
+    """
+    kexts = [kext for (kext, _) in configs]
+    labels = []
+    for (kext, maginput) in configs:
+        if kexts.count(kext) == 1 or not maginput:
+            labels.append(kext)
+        else:
+            labels.append('_'.join([kext, *['{}{}'.format(key, val) 
+                            for (key, val) in maginput.items()]]))
+    if len(set(labels)) != len(labels):
+        raise ValueError('Duplicate magnetic field model configurations!'
+                        '\nlabels={}'.format(labels))
+    return labels
+
+
 if __name__ == '__main__':
 #   from datetime import datetime
 #    for sc_id in ['FU3', 'FU4']:
@@ -0,0 +1,77 @@
+# This script loads data files in a background thread so that the file
+# I/O overlaps with the processing and plotting of the previous files.
+import queue
+import threading
+
+_DONE = object() # Marks the end of the items.
+
+class Prefetcher():
+    def __init__(self, items, loader, depth=2):
+        """
+        This class calls loader(item) for each item in a background thread
+        and yields the (item, data) pairs in order. At most depth loaded
+        items wait in the queue, so the thread blocks when the consumer
+        falls behind, so depth must be at least 1. Exceptions raised by 
+        the loader are re-raised in the consumer. Use it in a with block 
+        so the thread is stopped if the consumer raises or breaks out early.
+        """
+        # A queue.Queue with maxsize=0 is unbounded.
+        if depth < 1:
+            raise ValueError('The prefetch depth must be at least 1, '
+                            'got depth={}.'.format(depth))
+        self.items = items
+        self.loader = loader
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def __iter__(self):
+        while True:
+            item, data, err = self._queue.get()
+            if err is not None:
+                self.close()
+                raise err
+            if item is _DONE:
+                return
+            yield item, data
+
+    def close(self):
+        """ This method stops the background thread and waits for it. """
+        self._stop.set()
+        self._thread.join()
+        return
+
+    def _run(self):
+        """ This method loads the items, runs in the background thread. """
+        try:
+            for item in self.items:
+                if self._stop.is_set():
+                    return
+                self._put((item, self.loader(item), None))
+        except Exception as err:
+            self._put((None, None, err))
+            return
+        self._put((_DONE, None, None))
+        return
+
+    def _put(self, x):
+        """
+        This method puts x in the queue, but gives up if the prefetcher
+        was closed while waiting for space.
+        """
+        while not self._stop.is_set():
+            try:
+                self._queue.put(x, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        return
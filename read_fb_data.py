@@ -0,0 +1,58 @@
+# This script reads the FIREBIRD-II HiRes JSON-headed ASCII files, only
+# parsing the columns that are needed.
+import json
+import numpy as np
+
+from ephemeris import Ephem, parse_times
+
+# The HiRes columns used by lap_plots and their in-memory types. L and MLT
+# stay float64 so that the IRBEM -1E31 fill value compares exactly.
+HIRES_COLUMNS = {'Count_Time_Correction':np.float64, 'Col_counts':np.float32,
+                'Lat':np.float64, 'Lon':np.float64, 'Alt':np.float64,
+                'McIlwainL':np.float64, 'MLT':np.float64,
+                'Loss_cone_type':np.float32}
+
+def read_header(path):
+    """
+    This function reads and parses the JSON header (the leading lines
+    that start with '#') of a JSON-headed ASCII file.
+    """
+    lines = []
+    with open(path) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            lines.append(line[1:])
+    header = ''.join(lines)
+    return json.loads(header[header.find('{'):header.rfind('}')+1])
+
+def read_hires(path, columns=HIRES_COLUMNS):
+    """
+    This function reads the Time column and the requested columns of a
+    HiRes file. columns is a dictionary of column names and dtypes. Only
+    the text columns spanned by those variables are converted, in one
+    bulk pass over the file. Returns an Ephem with the times as epoch
+    times and the ELEMENT_LABELS of the multi-element columns (e.g.
+    Col_counts) in its attrs.
+    """
+    header = read_header(path)
+    # Find the text columns spanned by each variable.
+    spans = {}
+    for key in ['Time', *columns]:
+        start = header[key]['START_COLUMN']
+        spans[key] = list(range(start, start + header[key].get('DIMENSION', [1])[0]))
+    usecols = [c for key in spans for c in spans[key]]
+    dtype = [('c{}'.format(c), 'U32' if key == 'Time' else np.float64)
+            for key in spans for c in spans[key]]
+    raw = np.loadtxt(path, dtype=dtype, usecols=usecols, comments='#', ndmin=1)
+
+    cols = {}
+    attrs = {}
+    for (key, colType) in columns.items():
+        if len(spans[key]) == 1:
+            cols[key] = raw['c{}'.format(spans[key][0])].astype(colType)
+        else:
+            cols[key] = np.stack([raw['c{}'.format(c)] for c in spans[key]],
+                                axis=1).astype(colType)
+            attrs[key] = header[key].get('ELEMENT_LABELS')
+    return Ephem(parse_times(raw['c{}'.format(spans['Time'][0])]), cols, attrs)